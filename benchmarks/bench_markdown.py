@@ -0,0 +1,36 @@
+"""
+Micro-benchmark for render_markdown: compares converting with a new Markdown instance each time
+(as markdown.markdown() does) with the pooled converters.
+Run from the directory containing pykyll with: python -m pykyll.benchmarks.bench_markdown
+"""
+import timeit
+
+import markdown
+
+from pykyll.markdown import render_markdown
+
+short_text = "Some *emphasised* text, with a [link](https://example.com)"
+long_text = "\n\n".join([
+    "# A heading",
+    "A paragraph of text with `code`, **bold** and _italic_ text. " * 5,
+    "```\ndef f(x):\n    return x * 2\n```",
+    "| a | b |\n|---|---|\n| 1 | 2 |",
+    "* one\n* two\n* three",
+    "A footnote[^1].\n\n[^1]: The footnote"] * 4)
+
+
+def unpooled(text: str) -> str:
+    return markdown.markdown(text, extensions=['extra', 'fenced_code'], output_format='html')
+
+
+def main(number=500):
+    for name, text in [("short", short_text), ("long", long_text)]:
+        assert unpooled(text) == render_markdown(text)
+        before = min(timeit.repeat(lambda: unpooled(text), number=number, repeat=3)) / number
+        after = min(timeit.repeat(lambda: render_markdown(text), number=number, repeat=3)) / number
+        print(f"{name:>6} text: {before * 1e6:8.1f}us per call unpooled, {after * 1e6:8.1f}us pooled "
+              f"({(before - after) * 1e6:.1f}us saved)")
+
+
+if __name__ == "__main__":
+    main()
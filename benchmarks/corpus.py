@@ -0,0 +1,131 @@
+"""
+Generates synthetic sites, of configurable size, for benchmarking.
+Posts have front-matter, tags, headings, code blocks, images and links; there are also templates,
+SCSS (with partials) and static files
+"""
+import json
+import os
+import random
+
+from pykyll.contentengine import ContentEngine
+
+words = ("the quick brown fox jumps over lazy dog static site generator python template markdown render "
+         "performance cache build post page image code block function value return type class module").split()
+tag_names = ["python", "c++", "rust", "testing", "performance", "design", "tools", "c#", "web", "notes"]
+
+base_template = """<!DOCTYPE html>
+<html>
+<head>
+<title>{{ site.name }}{% if title %} - {{ title }}{% endif %}</title>
+<meta name="description" content="{{ page_summary | clean_for_attribute }}">
+<link rel="stylesheet" href="{{ static_root }}/css/site.css">
+</head>
+<body>
+{% for item in menu.left %}<a href="{{ rootdir }}{{ item.link }}">{{ item.title }}</a>{% endfor %}
+{% block content %}{% endblock %}
+{% include "footer.template.html" %}
+</body>
+</html>
+"""
+
+post_template = """{% extends "base.template.html" %}
+{% block content %}
+<h1>{{ post.metadata.title }}</h1>
+<p>{{ post.metadata.formatted_timestamp }}</p>
+{{ post.html_content }}
+{% endblock %}
+"""
+
+index_template = """{% extends "base.template.html" %}
+{% block content %}
+{% for post in posts %}
+<h2><a href="{{ post.metadata.page_name }}">{{ post.metadata.title }}</a></h2>
+{{ post.summary }}
+{% endfor %}
+{% endblock %}
+"""
+
+footer_template = """<footer>{{ site.author | markdown }}</footer>
+"""
+
+partial_scss = """$main-colour: #336699;
+$font-stack: 'Body Font', sans-serif;
+@mixin boxed($padding) { padding: $padding; border: 1px solid $main-colour; }
+"""
+
+site_scss = """@import 'variables';
+body { font-family: $font-stack; color: $main-colour; }
+.post { @include boxed(10px); h1 { font-size: 2em; } }
+"""
+
+plain_css = """body {
+    font-family: 'Heading Font', serif;
+    margin: 0;
+}
+"""
+
+
+def sentence(rng: random.Random, length: int) -> str:
+    return " ".join(rng.choice(words) for _ in range(length)).capitalize() + "."
+
+
+def paragraph(rng: random.Random) -> str:
+    return " ".join(sentence(rng, rng.randint(5, 20)) for _ in range(rng.randint(2, 6)))
+
+
+def make_post(rng: random.Random, index: int, paragraphs: int) -> str:
+    properties = {
+        "slug": f"post-{index}",
+        "guid": f"00000000-0000-0000-0000-{index:012}",
+        "hash": "",
+        "version": 1,
+        "tags": ", ".join(rng.sample(tag_names, rng.randint(1, 3)))
+    }
+    title = sentence(rng, rng.randint(3, 8)).rstrip(".")
+    blocks = []
+    if rng.random() < 0.5:
+        blocks.append(f'<img class="post-image" src="images/post-{index}.jpg">')
+    for i in range(paragraphs):
+        blocks.append(paragraph(rng))
+        if i % 3 == 1:
+            blocks.append(f"## {sentence(rng, 4)}")
+        if i % 4 == 2:
+            blocks.append("```python\ndef f(x):\n    return x * 2\n```")
+        if i % 5 == 3:
+            blocks.append(f"See [the docs](https://example.com/{index}/{i}) and ![an image](images/{index}-{i}.png)")
+    return f'<script type="application/json">\n{json.dumps(properties, indent=4)}\n</script>\n\n' \
+           f'# {title}\n\n' + "\n\n".join(blocks) + "\n"
+
+
+def generate_site(root: str, post_count: int = 1000, paragraphs: int = 12, static_file_count: int = 200,
+                  seed: int = 0) -> ContentEngine:
+    """
+    Writes a synthetic site under root, returning the ContentEngine for it
+    """
+    rng = random.Random(seed)
+    ce = ContentEngine(sources_root=root)
+    for path in [ce.posts_source_path, ce.templates_root, ce.content_source_path,
+                 os.path.join(ce.static_source_path, "css"), os.path.join(ce.static_source_path, "images")]:
+        os.makedirs(path, exist_ok=True)
+
+    for index in range(post_count):
+        day = index % 28 + 1
+        month = index // 28 % 12 + 1
+        year = 2000 + index // (28 * 12)
+        filename = f"{year:04}-{month:02}-{day:02}T10-{index % 60:02}.md"
+        with open(os.path.join(ce.posts_source_path, filename), "w") as f:
+            f.write(make_post(rng, index, paragraphs))
+
+    for name, text in [("base.template.html", base_template), ("post.template.html", post_template),
+                       ("index.template.html", index_template), ("footer.template.html", footer_template)]:
+        with open(os.path.join(ce.templates_root, name), "w") as f:
+            f.write(text)
+
+    css_dir = os.path.join(ce.static_source_path, "css")
+    for name, text in [("_variables.scss", partial_scss), ("site.scss", site_scss), ("plain.css", plain_css)]:
+        with open(os.path.join(css_dir, name), "w") as f:
+            f.write(text)
+    for index in range(static_file_count):
+        with open(os.path.join(ce.static_source_path, "images", f"image-{index}.png"), "wb") as f:
+            f.write(rng.randbytes(rng.randint(1000, 20000)))
+    return ce
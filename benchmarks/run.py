@@ -0,0 +1,142 @@
+"""
+Runs the benchmark suite over a synthetic site, storing the results (by git commit) so they can be compared
+between commits.
+Run from the directory containing pykyll with, e.g.:
+    python -m pykyll.benchmarks.run --posts 1000
+    python -m pykyll.benchmarks.run --compare <earlier commit>
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import timeit
+from datetime import datetime
+
+from pykyll.benchmarks.corpus import generate_site
+from pykyll.blog_builder import load_post_metadata, load_post_from_metadata, Post, read_post_content
+from pykyll.css_processor import CssProcessor
+from pykyll.fileutils import sync_files
+from pykyll.fonts import AvailableFonts
+from pykyll.html import slugify, make_description
+from pykyll.site import Site
+from pykyll.templater import Templater
+
+results_dir = os.path.join(os.path.dirname(__file__), "results")
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def time_it(fun, repeat: int) -> float:
+    """
+    Returns the best time, in seconds, of repeat runs of fun
+    """
+    return min(timeit.repeat(fun, number=1, repeat=repeat))
+
+
+def run_benchmarks(root: str, post_count: int, repeat: int) -> dict[str, float]:
+    root = os.path.abspath(root)
+    ce = generate_site(root, post_count)
+    site = Site(name="Benchmark", subtitle="", default_page_summary="A synthetic site", public_url="https://example.com",
+                image="", keywords="", author="A. N. Author", output_dir=os.path.join(root, "web"))
+    os.chdir(root)
+    results = {}
+
+    all_metadata = load_post_metadata(ce.posts_source_path, site.posts_base_url)
+    titles = [metadata.title for metadata in all_metadata]
+    posts = [load_post_from_metadata(metadata) for metadata in all_metadata]
+    htmls = [post.html_content for post in posts]
+    contents = [read_post_content(metadata) for metadata in all_metadata]
+
+    results["slugify"] = time_it(lambda: [slugify(title) for title in titles], repeat)
+    results["make_description"] = time_it(lambda: [make_description(html) for html in htmls], repeat)
+    results["load_post_metadata"] = time_it(
+        lambda: load_post_metadata(ce.posts_source_path, site.posts_base_url), repeat)
+    results["Post construction"] = time_it(
+        lambda: [Post(metadata, content) for metadata, content in zip(all_metadata, contents)], repeat)
+
+    templater = Templater(site, "_templates")
+
+    def render_pages():
+        for post in posts:
+            templater.render_to_file("post.template.html", os.path.join(site.posts_subdir, post.metadata.page_name),
+                                     post=post, title=post.metadata.title)
+        templater.render_to_file("index.template.html", "index.html", posts=posts[:20])
+    results["Templater.render_to_file"] = time_it(render_pages, repeat)
+
+    css_dir = os.path.join(ce.static_source_path, "css")
+    fonts_target_dir = os.path.join(site.static_target_path, "fonts")
+
+    def process_css():
+        processor = CssProcessor(AvailableFonts(ce.fonts_source_path), fonts_target_dir)
+        for filename in sorted(os.listdir(css_dir)):
+            processor.process(os.path.join(css_dir, filename), os.path.join(site.output_dir, "css", filename))
+    results["CssProcessor.process"] = time_it(process_css, repeat)
+
+    def sync_all():
+        shutil.rmtree(site.static_target_path, ignore_errors=True)
+        sync_files(ce.static_source_path, site.static_target_path)
+    results["sync_files"] = time_it(sync_all, repeat)
+    results["sync_files (no-op)"] = time_it(
+        lambda: sync_files(ce.static_source_path, site.static_target_path), repeat)
+    return results
+
+
+def load_results(commit: str) -> dict:
+    with open(os.path.join(results_dir, f"{commit}.json"), "r") as f:
+        return json.load(f)
+
+
+def save_results(commit: str, data: dict):
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, f"{commit}.json"), "w") as f:
+        json.dump(data, f, indent=4)
+
+
+def print_results(results: dict[str, float], baseline: dict[str, float] | None = None):
+    for name, seconds in results.items():
+        line = f"{name:<28} {seconds * 1000:10.1f}ms"
+        if baseline and name in baseline:
+            change = (seconds - baseline[name]) / baseline[name] * 100
+            line += f"  (was {baseline[name] * 1000:10.1f}ms, {change:+.1f}%)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the pykyll benchmark suite")
+    parser.add_argument("--posts", type=int, default=500, help="Number of posts in the synthetic site")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark (the best is taken)")
+    parser.add_argument("--compare", help="Commit whose stored results to compare against")
+    parser.add_argument("--no-save", action="store_true", help="Don't store the results")
+    args = parser.parse_args()
+
+    wd = os.getcwd()
+    root = tempfile.mkdtemp(prefix="pykyll-bench-")
+    try:
+        results = run_benchmarks(root, args.posts, args.repeat)
+    finally:
+        os.chdir(wd)
+        shutil.rmtree(root, ignore_errors=True)
+
+    commit = current_commit()
+    baseline = load_results(args.compare)["results"] if args.compare else None
+    print(f"Results for {commit}, with {args.posts} posts:")
+    print_results(results, baseline)
+    if not args.no_save:
+        save_results(commit, {
+            "commit": commit,
+            "date": datetime.now().isoformat(),
+            "posts": args.posts,
+            "results": results
+        })
+
+
+if __name__ == "__main__":
+    main()
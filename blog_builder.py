@@ -1,25 +1,32 @@
 import codecs
 import copy
 import hashlib
+import io
 import json
 import os
 import re
 import uuid
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, asdict
 from datetime import datetime
 from functools import cached_property
 
 import dateutil.parser
 import typing
 
-from pykyll.html import slugify, make_description, find_image_with_class
-from pykyll.markdown import render_markdown
+from pykyll.cache import JsonStore
+from pykyll.fileutils import file_signature
+from pykyll.instrumentation import timed
+from pykyll.html import slugify, HtmlAnalysis
+from pykyll.markdown import render_markdown, MarkdownCache
 from pykyll.utils import format_datetime_for_blog, format_datetime_for_rss, format_longdate
 
 open_script_parser = re.compile(r'.*?<script.*?>(.*)', re.DOTALL)
 close_script_parser = re.compile(r'(.*)</script>.*', re.DOTALL)
 html_title_parser = re.compile(r'.*?<h1>(.*?)</h1>.*', re.DOTALL)
 md_title_parser = re.compile(r'.*?#(.*)', re.DOTALL)
+# Matches a line, including its line break - using the same line boundaries as str.splitlines()
+line_parser = re.compile(r'[^\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]*(?:\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029])?')
 
 use_html_extension: bool = True
 
@@ -29,6 +36,19 @@ def set_use_html_extension(use: bool):
     use_html_extension = use
 
 
+class PostLoadError(Exception):
+    """
+    Raised when a post fails to load (e.g. in a worker process), identifying the post
+    """
+    def __init__(self, filename: str, message: str):
+        super().__init__(filename, message)
+        self.filename = filename
+        self.message = message
+
+    def __str__(self):
+        return f"{self.filename}: {self.message}"
+
+
 @dataclass
 class PostMetadata:
     filename: str
@@ -84,37 +104,93 @@ class PostMetadata:
             properties["tags"] = ", ".join(self.tags)
 
         return properties
-def read_metadata_strings(path: str) -> (str, str, int):
-    script_text = None
+def parse_metadata_lines(lines: typing.Iterable[str], path: str) -> (str, str, int):
+    """
+    Consumes lines only as far as the title, returning the text of the (JSON) script block, if any, the title,
+    and the line number the content starts from
+    """
+    script_parts = None
     reading_script = False
-    with codecs.open(path, "r", "utf-8") as file:
-        for line_no, line in enumerate(file.readlines()):
-            if not reading_script:
-                m = html_title_parser.match(line)
-                if not m:
-                    m = md_title_parser.match(line)
-                if m:
-                    title = m.group(1).strip()
-                    return script_text, title, line_no+1
+    for line_no, line in enumerate(lines):
+        if not reading_script:
+            m = html_title_parser.match(line)
+            if not m:
+                m = md_title_parser.match(line)
+            if m:
+                title = m.group(1).strip()
+                script_text = "".join(script_parts) if script_parts is not None else None
+                return script_text, title, line_no+1
+        else:
+            m = close_script_parser.match(line)
+            if not m:
+                script_parts.append(line)
             else:
-                m = close_script_parser.match(line)
-                if not m:
-                    script_text = script_text + line
-                else:
-                    script_text = script_text + m.group(1)
-                    reading_script = False
-
-            if script_text is None:
-                m = open_script_parser.match(line)
-                if m:
-                    script_text = m.group(1)
-                    reading_script = True
+                script_parts.append(m.group(1))
+                reading_script = False
+
+        if script_parts is None:
+            m = open_script_parser.match(line)
+            if m:
+                script_parts = [m.group(1)]
+                reading_script = True
 
     raise Exception(f"{path} has no title")
 
 
+def read_metadata_strings(path: str) -> (str, str, int):
+    with codecs.open(path, "r", "utf-8") as file:
+        # Iterating the file reads it lazily, so we stop reading at the title
+        return parse_metadata_lines(file, path)
+
+
+def lines_with_offsets(text: str) -> typing.Iterator[tuple[str, int]]:
+    """
+    Yields each line of text (split as by str.splitlines(keepends=True)) along with the offset it ends at
+    """
+    for m in line_parser.finditer(text):
+        end = m.end()
+        if end == m.start():
+            return
+        yield m.group(), end
+
+
+def content_offset(text: str, content_line_no: int) -> int:
+    """
+    Returns the offset into text of the start of line, content_line_no
+    """
+    offset = 0
+    if content_line_no > 0:
+        for line_no, (_, offset) in enumerate(lines_with_offsets(text), 1):
+            if line_no == content_line_no:
+                break
+    return offset
+
+
 def read_metadata(path: str, base_url: str) -> PostMetadata:
     properties_str, title, content_line_no = read_metadata_strings(path)
+    return metadata_from_strings(path, base_url, properties_str, title, content_line_no)
+
+
+def read_post(path: str, base_url: str) -> (PostMetadata, str):
+    """
+    Reads the metadata and the (markdown) content of a post from a single read of the file
+    """
+    with codecs.open(path, "r", "utf-8") as file:
+        text = file.read()
+    end = 0
+
+    def lines():
+        nonlocal end
+        for line, end in lines_with_offsets(text):
+            yield line
+
+    properties_str, title, content_line_no = parse_metadata_lines(lines(), path)
+    metadata = metadata_from_strings(path, base_url, properties_str, title, content_line_no)
+    return metadata, text[end:]
+
+
+def metadata_from_strings(path: str, base_url: str, properties_str: str, title: str, content_line_no: int) \
+        -> PostMetadata:
     is_dirty = False
     if properties_str:
         properties = json.loads(properties_str)
@@ -175,37 +251,119 @@ def read_metadata(path: str, base_url: str) -> PostMetadata:
     return metadata
 
 
+class PostMetadataIndex:
+    """
+    An on-disk index of post metadata, keyed by path, so posts that haven't changed since the last build
+    don't need to be re-read and re-parsed.
+    Entries are validated against the size and modification time of the post file.
+    Drafts (which are timestamped at load time) and dirty metadata (which will be written back) are not indexed
+    """
+    version = 1
+
+    def __init__(self, index_path: str):
+        self.store = JsonStore(index_path, self.version)
+
+    def get(self, path: str, base_url: str) -> PostMetadata | None:
+        entry = self.store.get(path)
+        if not entry or entry["signature"] != file_signature(path):
+            return None
+        properties = dict(entry["metadata"])
+        timestamp = properties["timestamp"]
+        properties["timestamp"] = datetime.fromisoformat(timestamp) if timestamp else None
+        return PostMetadata(filename=path, base_url=base_url, is_dirty=False, **properties)
+
+    def put(self, metadata: PostMetadata):
+        if metadata.is_dirty or metadata.is_draft:
+            self.store.remove(metadata.filename)
+            return
+        properties = asdict(metadata)
+        for name in ["filename", "base_url", "is_dirty"]:
+            del properties[name]
+        if metadata.timestamp:
+            properties["timestamp"] = metadata.timestamp.isoformat()
+        self.store.set(metadata.filename, {
+            "signature": file_signature(metadata.filename),
+            "metadata": properties
+        })
+
+    def read_metadata(self, path: str, base_url: str) -> PostMetadata:
+        """
+        Returns the indexed metadata for the path, if still valid - otherwise reads it from the file (and indexes it)
+        """
+        metadata = self.get(path, base_url)
+        if metadata is None:
+            metadata = read_metadata(path, base_url)
+            self.put(metadata)
+        return metadata
+
+    def retain_only(self, paths: list[str]):
+        """
+        Drops any entries for posts not in paths (e.g. that have been deleted)
+        """
+        keep = set(paths)
+        for path in self.store.keys():
+            if path not in keep:
+                self.store.remove(path)
+
+    def save(self):
+        self.store.save()
+
+
+def render_post_content(metadata: PostMetadata, md_content: str, render_cache: MarkdownCache | None = None) \
+        -> (str, PostMetadata):
+    """
+    Renders the markdown content of a post, returning the html and the metadata
+    - updated (as a copy), and marked as dirty, if the hash of the html has changed
+    """
+    if render_cache:
+        html_content, hash = render_cache.render(md_content)
+    else:
+        html_content = render_markdown(md_content)
+        hash = hashlib.sha256(html_content.encode()).hexdigest()
+    if hash != metadata.hash:
+        metadata = copy.deepcopy(metadata)
+        metadata.hash = hash
+        metadata.is_dirty = True
+    return html_content, metadata
+
+
 class Post:
-    def __init__(self, metadata: PostMetadata, md_content: str, summary_length = 500):
+    def __init__(self, metadata: PostMetadata, md_content: str, summary_length = 500,
+                 render_cache: MarkdownCache | None = None):
         self.md_content = md_content
-        self.html_content = render_markdown(md_content)
         self.summary_length = summary_length
-        hash = hashlib.sha256(self.html_content.encode()).hexdigest()
-        if hash == metadata.hash:
-            self.metadata = metadata
-        else:
-            self.metadata = copy.deepcopy(metadata)
-            self.metadata.hash = hash
-            self.metadata.is_dirty = True
+        self.html_content, self.metadata = render_post_content(metadata, md_content, render_cache)
+
+    @cached_property
+    def html_analysis(self) -> HtmlAnalysis:
+        """
+        The html content, parsed just once for the summary, description and page_image
+        """
+        return HtmlAnalysis(self.html_content)
 
     @cached_property
     def summary(self):
-        return make_description(
-            self.html_content,
+        return self.html_analysis.description(
             attribute_safe=False,
             wrap_in_p_tags=True,
             max_length=self.summary_length)
 
     @cached_property
     def description(self):
-        return make_description(self.html_content, max_length=300)
+        return self.html_analysis.description(max_length=300)
 
     @cached_property
     def page_image(self):
         if self.metadata.page_image:
             return self.metadata.page_image
         else:
-            return find_image_with_class(self.html_content, "post-image")
+            return self.html_analysis.find_image_with_class("post-image")
+
+    def __getstate__(self):
+        # The parsed html can't be pickled (e.g. to return from load_posts_parallel), but can always be parsed again
+        state = self.__dict__.copy()
+        state.pop("html_analysis", None)
+        return state
 
     def write(self, out_file: typing.TextIO):
         out_file.write('<script type="application/json">\n')
@@ -215,32 +373,161 @@ class Post:
         out_file.write(self.md_content.strip("\n"))
 
 
-def load_post_from_metadata(metadata: PostMetadata, summary_length=400) -> Post:
-    with codecs.open(metadata.filename, "r", "utf-8") as file:
-        content = "".join(file.readlines()[metadata.content_line_no:])
-    return Post(metadata, content, summary_length)
+class LazyPost(Post):
+    """
+    A Post that only reads its content when it's first needed, and only renders it when the html, summary or
+    description are first needed - so listing pages that only use the metadata (or page_image, if set in the
+    metadata) don't pay for rendering.
+    Until the content is rendered the metadata is as read (its hash not yet checked).
+    As it is a Post, the same object can be used for the post's own page, so it is still only rendered once
+    (and with a render_cache, the rendering is shared with other processes and builds)
+    """
+    def __init__(self, metadata: PostMetadata, summary_length = 400, render_cache: MarkdownCache | None = None):
+        self.source_metadata = metadata
+        self.summary_length = summary_length
+        self.render_cache = render_cache
 
+    @cached_property
+    def md_content(self) -> str:
+        return read_post_content(self.source_metadata)
 
-def load_post_metadata(posts_dir: str, base_url: str, recurse_subdirs = True) -> list[PostMetadata]:
-    paths = []
-    for root, _, files in os.walk(posts_dir):
-        paths += [os.path.join(root, file) for file in files if file.endswith(".md")]
-        if not recurse_subdirs:
-            break
-    paths.sort(reverse=True)
+    @cached_property
+    def rendered(self) -> (str, PostMetadata):
+        return render_post_content(self.source_metadata, self.md_content, self.render_cache)
 
-    return [read_metadata(path, base_url) for path in paths]
+    @property
+    def is_rendered(self) -> bool:
+        return "rendered" in self.__dict__
 
+    @property
+    def html_content(self) -> str:
+        return self.rendered[0]
 
-def load_post(posts_dir: str, base_url: str) -> Post:
-    metadata = read_metadata(posts_dir, base_url)
-    return load_post_from_metadata(metadata)
+    @property
+    def metadata(self) -> PostMetadata:
+        if self.is_rendered:
+            return self.rendered[1]
+        return self.source_metadata
 
 
-def save_post(post: Post):
-    basename, ext = os.path.splitext(post.metadata.filename)
+def read_post_content(metadata: PostMetadata) -> str:
+    with codecs.open(metadata.filename, "r", "utf-8") as file:
+        text = file.read()
+    return text[content_offset(text, metadata.content_line_no):]
+
+
+def load_post_from_metadata(metadata: PostMetadata, summary_length=400, render_cache: MarkdownCache | None = None) \
+        -> Post:
+    return Post(metadata, read_post_content(metadata), summary_length, render_cache)
+
+
+def load_lazy_posts(metadata_list: list[PostMetadata], summary_length=400, render_cache: MarkdownCache | None = None) \
+        -> list[LazyPost]:
+    return [LazyPost(metadata, summary_length, render_cache) for metadata in metadata_list]
+
+
+def _load_post_fully(metadata: PostMetadata, summary_length: int, render_cache: MarkdownCache | None) -> Post:
+    try:
+        post = load_post_from_metadata(metadata, summary_length, render_cache)
+        # Populate the cached properties here, so they are computed in the worker and travel back with the post
+        _ = post.summary, post.description, post.page_image
+        return post
+    except Exception as e:
+        raise PostLoadError(metadata.filename, f"{type(e).__name__}: {e}") from None
+
+
+def load_posts_parallel(
+        metadata_list: list[PostMetadata],
+        workers: int | None = None,
+        summary_length=400,
+        render_cache: MarkdownCache | None = None) -> list[Post]:
+    """
+    Loads and renders posts across a pool of worker processes, returning them in the same order as metadata_list.
+    The summary, description and page_image of each post are already computed.
+    If any posts fail to load, a PostLoadError is raised for the first failing post by position in metadata_list,
+    regardless of which worker failed first
+    """
+    if not metadata_list:
+        return []
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=set_use_html_extension,
+                             initargs=(use_html_extension,)) as executor:
+        futures = [executor.submit(_load_post_fully, metadata, summary_length, render_cache)
+                   for metadata in metadata_list]
+        return [future.result() for future in futures]
+
+
+def load_post_metadata(posts_dir: str, base_url: str, recurse_subdirs = True, index_path: str | None = None) \
+        -> list[PostMetadata]:
+    """
+    Reads the metadata for all posts in posts_dir, newest first.
+    If index_path is supplied, metadata for unchanged posts is taken from the index there (which is then updated)
+    """
+    with timed("metadata load"):
+        paths = []
+        for root, _, files in os.walk(posts_dir):
+            paths += [os.path.join(root, file) for file in files if file.endswith(".md")]
+            if not recurse_subdirs:
+                break
+        paths.sort(reverse=True)
+
+        if not index_path:
+            return [read_metadata(path, base_url) for path in paths]
+
+        index = PostMetadataIndex(index_path)
+        all_metadata = [index.read_metadata(path, base_url) for path in paths]
+        index.retain_only(paths)
+        index.save()
+        return all_metadata
+
+
+def load_post(posts_dir: str, base_url: str, render_cache: MarkdownCache | None = None) -> Post:
+    metadata, content = read_post(posts_dir, base_url)
+    return Post(metadata, content, summary_length=400, render_cache=render_cache)
+
+
+def serialize_post(post: Post) -> bytes:
+    out_file = io.StringIO()
+    post.write(out_file)
+    return out_file.getvalue().encode("utf-8")
+
+
+def write_post_file(filename: str, content: bytes, skip_unchanged=False) -> bool:
+    """
+    Replaces the post file with content, atomically: it's written alongside first, then moved into place.
+    If skip_unchanged is set, the file is not written if it already holds content.
+    Returns True if the file was written
+    """
+    if skip_unchanged:
+        try:
+            with open(filename, "rb") as existing_file:
+                if existing_file.read() == content:
+                    return False
+        except FileNotFoundError:
+            pass
+    basename, ext = os.path.splitext(filename)
     temp_filename = f"{basename}.new{ext}"
-    with codecs.open(temp_filename, "w", "utf-8") as out_file:
-        post.write(out_file)
-    os.remove(post.metadata.filename)
-    os.rename(temp_filename, post.metadata.filename)
+    with open(temp_filename, "wb") as out_file:
+        out_file.write(content)
+    os.replace(temp_filename, filename)
+    return True
+
+
+def save_post(post: Post):
+    write_post_file(post.metadata.filename, serialize_post(post))
+
+
+def save_dirty_posts(posts: list[Post], workers: int | None = None) -> int:
+    """
+    Saves the posts whose metadata is dirty (using a pool of threads for the I/O),
+    skipping any whose files would be unchanged.
+    Returns the number of post files written
+    """
+    def save_if_changed(post: Post) -> bool:
+        return write_post_file(post.metadata.filename, serialize_post(post), skip_unchanged=True)
+
+    dirty_posts = [post for post in posts if post.metadata.is_dirty]
+    if not dirty_posts:
+        return 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(save_if_changed, dirty_posts))
@@ -0,0 +1,105 @@
+import dataclasses
+import hashlib
+import json
+import os
+from datetime import datetime, date
+
+from pykyll.blog_builder import Post, PostMetadata
+from pykyll.cache import JsonStore
+from pykyll.fileutils import file_state
+
+
+class Untrackable(Exception):
+    """
+    Raised when data passed to a template can't be captured in a digest, so the output must always be rebuilt
+    """
+    pass
+
+
+class BuildGraph:
+    """
+    Records, for each output file, the input files it was built from (with their sizes, modification times and
+    content hashes) and a digest of any other data that went into it.
+    On the next build an output whose inputs and data are all unchanged can be skipped. Inputs are only read (to hash
+    them) if their size or modification time has changed.
+    Call save() at the end of the build to persist the graph
+    """
+    version = 2
+
+    def __init__(self, path: str):
+        self.store = JsonStore(path, self.version)
+        self.file_states = {}
+
+    def file_state(self, path: str, recorded: list | None = None) -> list | None:
+        return file_state(path, recorded, self.file_states)
+
+    def input_states(self, input_files) -> dict[str, list | None]:
+        return {path: self.file_state(path) for path in sorted(set(input_files))}
+
+    def is_up_to_date(self, output_path: str, input_files, digest: str) -> bool:
+        entry = self.store.get(output_path)
+        if entry is None or entry["digest"] != digest or not os.path.exists(output_path) or \
+                set(entry["inputs"]) != set(input_files):
+            return False
+        inputs = {}
+        for path, recorded in entry["inputs"].items():
+            state = self.file_state(path, recorded)
+            if (state and state[2]) != (recorded and recorded[2]):
+                return False
+            inputs[path] = state
+        # The contents are the same, but modification times may not be - so record them, to avoid hashing next time
+        self.store.set(output_path, {"digest": digest, "inputs": inputs})
+        return True
+
+    def record(self, output_path: str, input_files, digest: str | None):
+        """
+        Records what output_path was built from. A digest of None means the output can't be tracked
+        (so any previous record is dropped)
+        """
+        if digest is None:
+            self.store.remove(output_path)
+        else:
+            self.store.set(output_path, {"digest": digest, "inputs": self.input_states(input_files)})
+
+    def outputs_depending_on(self, input_files) -> list[str]:
+        """
+        Returns the recorded outputs that were built from any of the input files
+        """
+        input_files = {os.path.normpath(path) for path in input_files}
+        return [output_path for output_path in self.store.keys()
+                if any(os.path.normpath(path) in input_files for path in self.store.get(output_path)["inputs"])]
+
+    def save(self):
+        self.store.save()
+
+
+def make_digest(data, input_files: set[str]) -> str:
+    """
+    Returns a hash of data - which may contain dataclasses (such as Site or PostMetadata), Posts, and other plain
+    objects. The source files of any posts found are added to input_files.
+    Raises Untrackable if data contains anything that can't be captured (e.g. functions)
+    """
+    def to_json(obj):
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj, key=repr)
+        if isinstance(obj, PostMetadata):
+            input_files.add(obj.filename)
+        if isinstance(obj, Post):
+            # Everything a post renders comes from its source file (and metadata)
+            input_files.add(obj.metadata.filename)
+            return {"metadata": obj.metadata, "summary_length": obj.summary_length}
+        if callable(obj):
+            raise Untrackable(f"{obj!r} can't be tracked")
+        if dataclasses.is_dataclass(obj):
+            return {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj)}
+        if hasattr(obj, "__dict__"):
+            return {"type": type(obj).__name__, **vars(obj)}
+        raise Untrackable(f"{obj!r} can't be tracked")
+
+    try:
+        text = json.dumps(data, default=to_json, sort_keys=True)
+    except (TypeError, ValueError) as e:
+        raise Untrackable(str(e)) from e
+    return hashlib.sha256(text.encode()).hexdigest()
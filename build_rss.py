@@ -43,7 +43,8 @@ def build_rss(templater: Templater,
         rss_filename,
         post_data=post_data,
         last_build_date=last_build_date,
-        rootdir="/")
+        rootdir="/",
+        volatile_args=("last_build_date",))
 
 
 def build_posterchild(site_name: str,
@@ -0,0 +1,114 @@
+import json
+import os
+
+
+class JsonStore:
+    """
+    A dictionary that is persisted as a JSON file between builds.
+    A missing or unreadable file, or one written with a different version, just starts off empty
+    """
+    def __init__(self, path: str | None, version: int = 1):
+        self.path = path
+        self.version = version
+        self.data = {}
+        self.is_dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    stored = json.load(f)
+                if stored.get("version") == version:
+                    self.data = stored.get("data", {})
+            except (OSError, ValueError, AttributeError):
+                pass
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key: str, value):
+        if self.data.get(key) != value:
+            self.data[key] = value
+            self.is_dirty = True
+
+    def remove(self, key: str):
+        if key in self.data:
+            del self.data[key]
+            self.is_dirty = True
+
+    def keys(self) -> list[str]:
+        return list(self.data.keys())
+
+    def save(self):
+        """
+        Writes the store back to disk, if anything changed.
+        The file is written alongside and then moved into place, so an interrupted build can't corrupt it
+        """
+        if not self.path or not self.is_dirty:
+            return
+        parent_dir = os.path.dirname(self.path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        temp_path = f"{self.path}.new"
+        with open(temp_path, "w") as f:
+            json.dump({"version": self.version, "data": self.data}, f)
+        os.replace(temp_path, self.path)
+        self.is_dirty = False
+
+
+# The number of entries in each BlobCache directory, as counted (once) by this process. Kept here, rather than on the
+# BlobCache, because caches are pickled into every task handed to a process pool
+entry_counts = {}
+
+
+class BlobCache:
+    """
+    A directory of files, each named by a key (typically a content hash) and persisted between builds.
+    Capped at max_entries by evicting the least recently used (by modification time, which is refreshed on each hit).
+    Writes are atomic, so the cache can be shared between processes
+    """
+    def __init__(self, directory: str, max_entries: int = 10000):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> bytes | None:
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        entry_count = entry_counts.get(self.directory)
+        if entry_count is None:
+            os.makedirs(self.directory, exist_ok=True)
+            entry_count = len(os.listdir(self.directory))
+        path = self.path_for(key)
+        is_new = not os.path.exists(path)
+        temp_path = f"{path}.{os.getpid()}.new"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        if is_new:
+            entry_count += 1
+        entry_counts[self.directory] = entry_count
+        if entry_count > self.max_entries:
+            self.trim()
+
+    def trim(self):
+        """
+        Evicts the least recently used entries, leaving the cache at 90% of max_entries
+        """
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        keep = self.max_entries * 9 // 10
+        for entry in entries[:max(len(entries) - keep, 0)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass  # Already evicted by another process
+        entry_counts[self.directory] = min(len(entries), keep)
@@ -1,32 +1,158 @@
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import sass
 
-from pykyll.fileutils import path_diff, ensure_parent_dirs
+from pykyll.cache import BlobCache, JsonStore
+from pykyll.fileutils import path_diff, ensure_parent_dirs, SyncManifest, file_state
 from pykyll.fonts import AvailableFonts
+from pykyll.instrumentation import timed
 from pykyll.templater import Templater
 
 font_re = re.compile(r"\s*font-family\s*:\s*(.*?);")
 font_var_re = re.compile(r"\s*--.*?font\s*:\s*(.*?);")
+scss_import_re = re.compile(r"@(?:import|use|forward)\s+((?:[\"'][^\"']*[\"']\s*,?\s*)+)")
+scss_import_name_re = re.compile(r"[\"']([^\"']*)[\"']")
+scss_extensions = [".scss", ".sass", ".css"]
+
+
+def is_scss_partial(source_path: str) -> bool:
+    return os.path.basename(source_path).startswith("_")
+
+
+def find_scss_entries(source_dir: str) -> list[str]:
+    """
+    Returns the paths of all the (non-partial) scss files under source_dir - the ones that get compiled
+    """
+    return sorted(os.path.join(root, filename)
+                  for root, _, files in os.walk(source_dir)
+                  for filename in files
+                  if filename.endswith(".scss") and not is_scss_partial(filename))
+
+
+def scss_import_candidates(name: str, importing_dir: str) -> list[str]:
+    """
+    The files an @import, @use or @forward of name may refer to, in the order sass looks for them
+    """
+    if name.startswith(("sass:", "http://", "https://", "//", "url(")):
+        return []
+    path = os.path.join(importing_dir, name)
+    directory, base = os.path.split(path)
+    if os.path.splitext(base)[1] in scss_extensions:
+        return [path, os.path.join(directory, f"_{base}")]
+    candidates = []
+    for ext in scss_extensions:
+        candidates += [f"{path}{ext}", os.path.join(directory, f"_{base}{ext}")]
+    for ext in scss_extensions[:2]:
+        candidates += [os.path.join(path, f"_index{ext}"), os.path.join(path, f"index{ext}")]
+    return candidates
+
+
+def scss_dependencies(source_path: str) -> list[str]:
+    """
+    Returns source_path and all the files it imports (directly or indirectly) - along with the files that sass would
+    have looked for first, but don't exist (so creating one of those changes what's imported, too).
+    Imports are found with a regex, so ones that are commented out are included - which only costs the occasional
+    unnecessary recompile
+    """
+    dependencies = [source_path]
+    to_scan = [source_path]
+    while to_scan:
+        path = to_scan.pop()
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            content = f.read()
+        for match in scss_import_re.finditer(content):
+            for name in scss_import_name_re.findall(match.group(1)):
+                for candidate in scss_import_candidates(name, os.path.dirname(path)):
+                    is_new = candidate not in dependencies
+                    if is_new:
+                        dependencies.append(candidate)
+                    if os.path.isfile(candidate):
+                        if is_new:
+                            to_scan.append(candidate)
+                        break
+    return dependencies
+
+
+def compile_scss(source_path: str) -> str:
+    with timed("scss compile"):
+        return sass.compile(filename=source_path)
+
+
+class ScssCache:
+    """
+    The css compiled from each scss file, persisted between builds, along with the state of every file it depends on
+    (see scss_dependencies), so it's only compiled again if one of those changes - including partials
+    """
+    version = 1
+
+    def __init__(self, path: str | None):
+        self.store = JsonStore(path, self.version)
+        self.file_states = {}
+
+    def get(self, source_path: str) -> str | None:
+        """
+        Returns the css compiled from source_path, if none of its dependencies have changed since
+        """
+        entry = self.store.get(source_path)
+        if entry is None or entry["sass"] != sass.__version__:
+            return None
+        dependencies = {}
+        for path, recorded in entry["dependencies"].items():
+            state = file_state(path, recorded, self.file_states)
+            if (state and state[2]) != (recorded and recorded[2]):
+                return None
+            dependencies[path] = state
+        # Modification times may have changed, even though contents haven't - so record them, to avoid hashing again
+        self.store.set(source_path, entry | {"dependencies": dependencies})
+        return entry["css"]
+
+    def dependency_states(self, source_path: str) -> dict[str, list | None]:
+        return {path: file_state(path, known_states=self.file_states) for path in scss_dependencies(source_path)}
+
+    def set(self, source_path: str, css: str, dependency_states: dict[str, list | None]):
+        """
+        Records the css compiled from source_path, with the state of its dependencies from before it was compiled
+        """
+        self.store.set(source_path, {"sass": sass.__version__, "dependencies": dependency_states, "css": css})
+
+    def remove_missing(self):
+        """
+        Forgets about scss files that no longer exist
+        """
+        for source_path in self.store.keys():
+            if not os.path.exists(source_path):
+                self.store.remove(source_path)
+
+    def save(self):
+        self.store.save()
 
 
 class CssProcessor:
 
-    def __init__(self, available_fonts : AvailableFonts, fonts_target_dir: str, **template_args):
+    def __init__(self, available_fonts : AvailableFonts, fonts_target_dir: str, scss_cache: ScssCache | None = None,
+                 **template_args):
+        """
+        With an scss_cache, scss is only compiled if it, or anything it imports, has changed since it was last compiled
+        """
         self.available_fonts = available_fonts
         self.all_required_fonts = set()
         self.fonts_target_dir = fonts_target_dir
+        self.scss_cache = scss_cache
         self.template_args = template_args
 
-    def process(self, source_path: str, target_path: str) -> bool:
+    def process(self, source_path: str, target_path: str) -> bool | str:
+        """
+        Processes css or scss (for sync_files()), returning whether it was processed - or, for scss, the path of the css
+        written
+        """
         path_without_ext, ext = os.path.splitext(target_path)
         match ext:
             case ".css":
                 return self.process_css_file(source_path, target_path)
             case ".scss":
-                filename = os.path.basename(source_path)
-                if filename.startswith("_"):
+                if is_scss_partial(source_path):
                     # This is a partial file (to be imported) so shouldn't be synced
                     return True
                 return self.process_scss(source_path, f"{path_without_ext}.css")
@@ -95,11 +221,49 @@ class CssProcessor:
         processed_lines = processed_lines + ["/* end of web fonts */", ""] + css_lines
         return processed_lines
 
-    def sync_fonts(self, target_root: str):
-        for font in self.all_required_fonts:
-            self.available_fonts.sync_font(font, self.fonts_target_dir)
+    def sync_fonts(self, target_root: str, manifest: SyncManifest | None = None, workers: int | None = None,
+                   font_cache: BlobCache | None = None, subset_chars: str | None = None):
+        """
+        Syncs all the fonts required by the CSS processed so far, converting them in a pool of (up to workers)
+        processes, reusing conversions from font_cache. With a manifest, fonts are only converted if their contents
+        have changed, and converted fonts whose sources have been deleted are removed.
+        To subset the fonts to the characters the site uses, call this after generating the site, with
+        subset_chars=used_characters(output_dir) (and a manifest)
+        """
+        self.available_fonts.sync_fonts(self.all_required_fonts, self.fonts_target_dir, manifest=manifest,
+                                        workers=workers, font_cache=font_cache, subset_chars=subset_chars)
+        if manifest:
+            manifest.remove_orphans(self.fonts_target_dir)
+
+    def precompile_scss(self, source_paths: list[str], workers: int | None = None) -> int:
+        """
+        Compiles any of the scss files (e.g. from find_scss_entries()) that aren't up to date in the scss_cache, in a
+        pool of (up to workers) processes, returning how many were compiled.
+        Call this before syncing (which processes files one at a time) so process_scss() finds them all in the cache
+        """
+        if self.scss_cache is None:
+            raise Exception("Precompiling scss needs an ScssCache, to keep the compiled css in")
+        stale = [(source_path, self.scss_cache.dependency_states(source_path)) for source_path in source_paths
+                 if self.scss_cache.get(source_path) is None]
+        if len(stale) == 1 or workers == 1:
+            compiled = [compile_scss(source_path) for source_path, _ in stale]
+        elif stale:
+            with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(stale))) as executor:
+                compiled = list(executor.map(compile_scss, [source_path for source_path, _ in stale]))
+        else:
+            compiled = []
+        for (source_path, dependency_states), css in zip(stale, compiled):
+            self.scss_cache.set(source_path, css, dependency_states)
+        return len(stale)
 
-    def process_scss(self, source_path: str, target_path: str) -> bool:
-        css = sass.compile(filename=source_path)
+    def process_scss(self, source_path: str, target_path: str) -> str:
+        css = self.scss_cache.get(source_path) if self.scss_cache else None
+        if css is None:
+            if self.scss_cache:
+                dependency_states = self.scss_cache.dependency_states(source_path)
+                css = compile_scss(source_path)
+                self.scss_cache.set(source_path, css, dependency_states)
+            else:
+                css = compile_scss(source_path)
         self.process_css(css, target_path, always_write=True)
-        return True
+        return target_path
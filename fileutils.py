@@ -1,8 +1,15 @@
+import hashlib
 import os
 import pathlib
 import datetime
 import shutil
+import tempfile
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
+from pykyll.cache import JsonStore
+from pykyll.instrumentation import timed
 from pykyll.utils import common_prefix
 
 
@@ -21,6 +28,14 @@ def get_file_modified_time(filename: str):
         return datetime.datetime.fromtimestamp(path.stat().st_mtime)
 
 
+def file_signature(filename: str) -> list[int]:
+    """
+    A cheap fingerprint of a file's contents, for caches: its size and modification time (in ns)
+    """
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
 def needs_sync(source_file: str, target_file: str) -> bool:
     """
     Checks if target exists and is not older than source
@@ -29,34 +44,345 @@ def needs_sync(source_file: str, target_file: str) -> bool:
     return not os.path.exists(target_file) or os.path.getmtime(source_file) > os.path.getmtime(target_file)
 
 
-def sync_file(source_path: str, target_dir: str, always_copy=False, processor=None, ignore_absence=False) -> bool:
+def hash_file(filename: str) -> str:
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_state(path: str, recorded: list | None = None, known_states: dict | None = None) -> list | None:
+    """
+    Returns the file's [size, modification time, content hash], or None if it doesn't exist.
+    The hash is taken from recorded (or known_states, which is kept up to date) if the size and modification time are
+    the same
+    """
+    if known_states is None:
+        known_states = {}
+    try:
+        signature = file_signature(path)
+    except OSError:
+        return None
+    for state in recorded, known_states.get(path):
+        if state and state[:2] == signature:
+            return state
+    state = known_states[path] = signature + [hash_file(path)]
+    return state
+
+
+class SyncManifest:
+    """
+    Records, for each synced target file, the content hashes of the sources it was synced from (and of the target
+    itself, as written). A target is up to date if those contents haven't changed - whatever the modification times
+    say, so e.g. a fresh clone doesn't cause everything to be synced again. Files are only hashed when their size or
+    modification time differ from those recorded with the hash.
+    Targets whose sources have been deleted can be removed with remove_orphans().
+    Files that were dealt with by a processor are never up to date, as what they produce may depend on more than the
+    source (e.g. the partials an scss file imports) - so the processor always gets to decide (caching as it sees fit).
+    Call save() at the end of the build to persist the manifest
+    """
+    version = 2
+
+    def __init__(self, path: str | None):
+        self.store = JsonStore(path, self.version)
+        self.file_states = {}
+
+    def file_state(self, path: str, recorded: list | None = None) -> list | None:
+        return file_state(path, recorded, self.file_states)
+
+    def is_up_to_date(self, target_path: str, source_paths: list[str], digest: str | None = None) -> bool:
+        """
+        Checks if the target and its sources are unchanged since the target was recorded - along with the digest of
+        anything else that went into it
+        """
+        entry = self.store.get(target_path)
+        if entry is None or entry.get("is_processed") or set(entry["sources"]) != set(source_paths) or \
+                entry.get("digest") != digest:
+            return False
+        sources = {}
+        for source_path, recorded in entry["sources"].items():
+            state = self.file_state(source_path, recorded)
+            if state is None or state[2] != recorded[2]:
+                return False
+            sources[source_path] = state
+        target = None
+        if entry["target"] is not None:
+            target = self.file_state(target_path, entry["target"])
+            if target is None or target[2] != entry["target"][2]:
+                return False
+        # The contents are the same, but modification times may not be - so record them, to avoid hashing next time
+        self.store.set(target_path, {"sources": sources, "target": target, "digest": digest})
+        return True
+
+    def record(self, target_path: str, source_paths: list[str], is_copy=False, has_target=True,
+               digest: str | None = None, is_processed=False):
+        """
+        Records that target_path has been synced from source_paths (and anything else, summarised by digest).
+        If is_copy, the target is a copy of the (single) source, so doesn't need hashing.
+        If not has_target then only the sources are tracked (e.g. when a processor writes somewhere else).
+        If is_processed, the target is only recorded so it can be removed if the source is
+        """
+        sources = {source_path: self.file_state(source_path) for source_path in source_paths}
+        target = None
+        if is_copy:
+            target = file_signature(target_path) + [sources[source_paths[0]][2]]
+        elif has_target:
+            target = self.file_state(target_path)
+        entry = {"sources": sources, "target": target, "digest": digest}
+        if is_processed:
+            entry["is_processed"] = True
+        self.store.set(target_path, entry)
+
+    def record_processed(self, target_path: str, source_path: str, processed: bool | str):
+        """
+        Records a file that was dealt with by a processor, which returned processed - which may be the path it wrote,
+        if that's not target_path (e.g. the css compiled from scss), so the output can be removed with the source
+        """
+        output_path = processed if isinstance(processed, str) else target_path
+        self.record(output_path, [source_path], has_target=os.path.exists(output_path), is_processed=True)
+
+    def remove_orphans(self, target_dir: str | None = None) -> list[str]:
+        """
+        Removes targets (within target_dir, if given) whose sources no longer exist, returning their paths
+        """
+        prefix = os.path.join(os.path.normpath(target_dir), "") if target_dir else ""
+        removed = []
+        for target_path in self.store.keys():
+            if not os.path.normpath(target_path).startswith(prefix):
+                continue
+            entry = self.store.get(target_path)
+            if all(os.path.exists(source_path) for source_path in entry["sources"]):
+                continue
+            if entry["target"] is not None and os.path.exists(target_path):
+                os.remove(target_path)
+                removed.append(target_path)
+            self.store.remove(target_path)
+        return removed
+
+    def save(self):
+        self.store.save()
+
+
+# Ways of syncing a file to the target: copying it (as shutil.copy2), hard linking to it (so it's never physically
+# copied), or copying it with copy_file_range (which lets the filesystem share or offload the copy)
+COPY = "copy"
+HARDLINK = "hardlink"
+COPY_FILE_RANGE = "copy_file_range"
+# Copies are handed to worker threads in batches, as copying most (small) files takes less time than handing it over
+sync_batch_size = 64
+
+
+@dataclass
+class SyncStats:
+    """
+    What sync_files() has done. Linked files share the source's data, so their bytes weren't physically copied.
+    Removed files are targets whose sources have been deleted (only when syncing with a SyncManifest)
+    """
+    files_copied: int = 0
+    bytes_copied: int = 0
+    files_linked: int = 0
+    bytes_linked: int = 0
+    files_processed: int = 0
+    files_up_to_date: int = 0
+    files_removed: int = 0
+
+    @property
+    def files_synced(self) -> int:
+        return self.files_copied + self.files_linked + self.files_processed
+
+
+def copy_with_copy_file_range(source_path: str, target_path: str):
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        while os.copy_file_range(source.fileno(), target.fileno(), 1 << 30):
+            pass
+    shutil.copystat(source_path, target_path)
+
+
+def replace_file(target_path: str, write: typing.Callable[[str], None]):
+    """
+    Calls write(temp_path) to create a new file, with a unique (hidden) name alongside target_path, which then
+    replaces the target - or, if writing fails, is removed
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path) or ".", prefix=".", suffix=".sync")
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def link_file(source_path: str, temp_path: str):
+    os.remove(temp_path)  # As os.link won't replace it
+    os.link(source_path, temp_path)
+
+
+def copy_file(source_path: str, target_path: str, mode=COPY) -> bool:
+    """
+    Copies the file, with its metadata, in the given mode - falling back to an ordinary copy where the mode isn't
+    supported (e.g. hard linking across filesystems). Returns True if the file was hard linked, rather than copied.
+    The target is always replaced, never written to, as it may be a hard link to the source (from an earlier sync)
+    """
+    if mode == HARDLINK:
+        if os.path.exists(target_path) and os.path.samefile(source_path, target_path):
+            return True
+        try:
+            replace_file(target_path, lambda temp_path: link_file(source_path, temp_path))
+            return True
+        except OSError:
+            pass
+    if mode == COPY_FILE_RANGE and hasattr(os, "copy_file_range"):
+        try:
+            replace_file(target_path, lambda temp_path: copy_with_copy_file_range(source_path, temp_path))
+            return False
+        except OSError:
+            pass
+    replace_file(target_path, lambda temp_path: shutil.copy2(source_path, temp_path))
+    return False
+
+
+def unlink_from_source(source_path: str, target_path: str):
+    """
+    Removes the target if it's a hard link to the source, so a processor writing the target can't overwrite the source
+    """
+    try:
+        if os.path.samefile(source_path, target_path):
+            os.remove(target_path)
+    except FileNotFoundError:
+        pass
+
+
+def sync_file(source_path: str, target_dir: str, always_copy=False, processor=None, ignore_absence=False,
+              mode=COPY, manifest: SyncManifest | None = None) -> bool:
+    """
+    Syncs the file into target_dir if it's missing or older there - or, with a manifest, if the contents of either
+    have changed since it was last synced (or it was dealt with by the processor)
+    """
     if ignore_absence and not os.path.exists(source_path):
         return False
 
     source_file = os.path.basename(source_path)
     target_path = os.path.join(target_dir, source_file)
-    if not always_copy and not needs_sync(source_path, target_path):
-        return False
+    if not always_copy:
+        if manifest:
+            if manifest.is_up_to_date(target_path, [source_path]):
+                return False
+        elif not needs_sync(source_path, target_path):
+            return False
 
     ensure_dirs(target_dir)
 
-    if not processor or not processor(source_path, target_path):
-        shutil.copy2(source_path, target_path)
+    if processor:
+        unlink_from_source(source_path, target_path)
+    processed = processor(source_path, target_path) if processor else False
+    if processed:
+        if manifest:
+            manifest.record_processed(target_path, source_path, processed)
+    else:
+        copy_file(source_path, target_path, mode)
+        if manifest:
+            manifest.record(target_path, [source_path], is_copy=True)
     return True
 
 
-def sync_files(source_dir: str, target_dir: str, always_copy=False, processor=None) -> int:
-    synced = 0
-    for file in os.listdir(source_dir):
-        source_path = os.path.join(source_dir, file)
-        if os.path.isdir(source_path):
-            synced = synced + sync_files(os.path.join(source_dir, file),
-                                         os.path.join(target_dir, file),
-                                         always_copy, processor)
-        else:
-            if sync_file(source_path, target_dir, always_copy=always_copy, processor=processor):
-                synced = synced + 1
-    return synced
+def scan_dir(dir_name: str) -> dict[str, os.DirEntry]:
+    try:
+        with os.scandir(dir_name) as entries:
+            return {entry.name: entry for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+def is_up_to_date(source: os.DirEntry, target: os.DirEntry | None) -> bool:
+    """
+    As needs_sync(), but using the stats cached by os.scandir()
+    """
+    if target is None:
+        return False
+    try:
+        return source.stat().st_mtime <= target.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def copy_files(copies: list[tuple[str, str, int]], mode=COPY) -> list[bool]:
+    return [copy_file(source_path, target_path, mode) for source_path, target_path, _ in copies]
+
+
+def sync_files(source_dir: str, target_dir: str, always_copy=False, processor=None, mode=COPY,
+               workers: int | None = None, stats: SyncStats | None = None, manifest: SyncManifest | None = None) -> int:
+    """
+    Syncs all the files under source_dir to the same places under target_dir, where they are missing or older,
+    returning how many were synced.
+    With a manifest, files are synced if their contents have changed (see SyncManifest) instead - except that files a
+    processor dealt with are always given to it again - and targets under target_dir whose sources have been deleted
+    are removed.
+    If given, processor(source_path, target_path) is called first, and if it returns True (or the path it wrote, if
+    that's not target_path) the file is taken to have been dealt with. It's always called from this thread, while copies are made, in batches, on a pool of worker
+    threads. Details of what was done are added to stats, if supplied
+    """
+    with timed("file sync"):
+        if stats is None:
+            stats = SyncStats()
+        synced = 0
+        batches = []
+        with ThreadPoolExecutor(workers) as executor:
+            dirs_to_sync = [(source_dir, target_dir)]
+            batch = []
+            while dirs_to_sync:
+                source_subdir, target_subdir = dirs_to_sync.pop()
+                target_entries = scan_dir(target_subdir)
+                has_target_dir = bool(target_entries)
+                with os.scandir(source_subdir) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            dirs_to_sync.append((entry.path, os.path.join(target_subdir, entry.name)))
+                            continue
+                        target_path = os.path.join(target_subdir, entry.name)
+                        if not always_copy:
+                            if manifest:
+                                up_to_date = manifest.is_up_to_date(target_path, [entry.path])
+                            else:
+                                up_to_date = is_up_to_date(entry, target_entries.get(entry.name))
+                            if up_to_date:
+                                stats.files_up_to_date += 1
+                                continue
+                        if not has_target_dir:
+                            ensure_dirs(target_subdir)
+                            has_target_dir = True
+                        synced += 1
+                        if processor and entry.name in target_entries:
+                            unlink_from_source(entry.path, target_path)
+                        if processor and (processed := processor(entry.path, target_path)):
+                            stats.files_processed += 1
+                            if manifest:
+                                manifest.record_processed(target_path, entry.path, processed)
+                            continue
+                        batch.append((entry.path, target_path, entry.stat().st_size))
+                        if len(batch) == sync_batch_size:
+                            batches.append((executor.submit(copy_files, batch, mode), batch))
+                            batch = []
+            if batch:
+                batches.append((executor.submit(copy_files, batch, mode), batch))
+
+            for copying, batch in batches:
+                for was_linked, (source_path, target_path, size) in zip(copying.result(), batch):
+                    if was_linked:
+                        stats.files_linked += 1
+                        stats.bytes_linked += size
+                    else:
+                        stats.files_copied += 1
+                        stats.bytes_copied += size
+                    if manifest:
+                        manifest.record(target_path, [source_path], is_copy=True)
+        if manifest:
+            stats.files_removed += len(manifest.remove_orphans(target_dir))
+        return synced
 
 
 def resolve_relative_path(relative_path: str) -> str:
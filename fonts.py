@@ -1,17 +1,43 @@
+import hashlib
+import html
+import io
 import os
+import re
 import shutil
+import typing
+from concurrent.futures import ProcessPoolExecutor
 
+import fontTools
+import fontTools.subset
 import yaml
 from fontTools.ttLib import TTFont
 
-from pykyll.fileutils import ensure_dirs, needs_sync
+from pykyll.cache import BlobCache, JsonStore
+from pykyll.fileutils import ensure_dirs, needs_sync, SyncManifest, hash_file
 from pykyll.html import slugify
+from pykyll.instrumentation import timed
+
+# Markup, scripts, styles and comments - which aren't shown in any font
+non_text_parser = re.compile(r"<script\b.*?</script>|<style\b.*?</style>|<!--.*?-->|<[^>]*>", re.DOTALL | re.IGNORECASE)
+printable_ascii = "".join(chr(c) for c in range(0x20, 0x7f))
 
 
 class FontInfo:
 
-    def __init__(self, font_dir: str):
+    def __init__(self, font_dir: str, properties: dict | None = None):
+        """
+        Reads the details of the font in font_dir - unless already known (from to_properties())
+        """
         self.font_dir = font_dir
+        if properties:
+            self.otf_file = properties["otf-file"]
+            self.txt_file = properties["txt-file"]
+            self.font_family = properties["font-family"]
+            self.font_weight = properties["font-weight"]
+            self.font_style = properties["font-style"]
+            self.slug = slugify(self.font_family)
+            return
+
         self.otf_file = None
         self.txt_file = None
         info_file = None
@@ -47,49 +73,252 @@ class FontInfo:
 
         self.slug = slugify(self.font_family)
 
+    def to_properties(self) -> dict:
+        return {
+            "otf-file": self.otf_file,
+            "txt-file": self.txt_file,
+            "font-family": self.font_family,
+            "font-weight": self.font_weight,
+            "font-style": self.font_style
+        }
+
+
+def font_dir_signature(font_dir: str) -> list[int]:
+    """
+    The modification times of the font directory and any info (yml) files in it - which change if the font's files
+    are added, removed or renamed, or its info is edited
+    """
+    signature = [os.stat(font_dir).st_mtime_ns]
+    with os.scandir(font_dir) as entries:
+        signature += sorted(entry.stat().st_mtime_ns for entry in entries if entry.name.endswith(".yml"))
+    return signature
+
 
 class AvailableFonts:
-    def __init__(self, fonts_dir: str):
+    """
+    The fonts in fonts_dir - one subdirectory per font, found by family name.
+    Fonts are only looked at when first asked for. What's found is kept in an index (persisted at index_path, if
+    given) so later lookups, and builds, only need to check the font's directory hasn't changed. When asked for a
+    family that isn't in the index (such as sans-serif) every font directory is checked, and only changed ones read -
+    and fonts_dir is only listed if it has changed since it was last listed
+    """
+    version = 1
+    # The index key under which the modification time of fonts_dir, when it was last listed, is kept - which can't
+    # be the name of a font directory
+    scanned_key = "/"
+
+    def __init__(self, fonts_dir: str, index_path: str | None = None):
+        self.fonts_dir = fonts_dir
+        self.index = JsonStore(index_path, self.version)
+        self.found_fonts = {}
+        self.is_index_complete = False
 
-        self.fonts = {}
+    def fonts_dir_signature(self) -> int | None:
+        try:
+            return os.stat(self.fonts_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
 
-        if os.path.exists(fonts_dir):
-            for font_dir in os.listdir(fonts_dir):
-                font_dir = os.path.join(fonts_dir, font_dir)
-                if os.path.isdir(font_dir):
-                    info = FontInfo(font_dir)
-                    self.fonts[info.font_family.lower()] = info
+    def font_dir_names(self) -> list[str]:
+        return [dir_name for dir_name in self.index.keys() if dir_name != self.scanned_key]
+
+    def load_font(self, dir_name: str) -> FontInfo | None:
+        """
+        Returns the font in the directory, using the index if the directory hasn't changed
+        """
+        font_dir = os.path.join(self.fonts_dir, dir_name)
+        try:
+            signature = font_dir_signature(font_dir)
+        except (FileNotFoundError, NotADirectoryError):
+            self.index.remove(dir_name)
+            return None
+        entry = self.index.get(dir_name)
+        if entry and entry["signature"] == signature:
+            return FontInfo(font_dir, entry["font"])
+        font = FontInfo(font_dir)
+        self.index.set(dir_name, {"signature": signature, "font": font.to_properties()})
+        return font
+
+    def update_index(self):
+        """
+        Brings the whole index up to date with the fonts_dir
+        """
+        fonts_dir_signature = self.fonts_dir_signature()
+        dir_names = []
+        if self.scanned_key in self.index.keys() and self.index.get(self.scanned_key) == fonts_dir_signature:
+            # No font directories have been added, removed or renamed since fonts_dir was last listed
+            dir_names = self.font_dir_names()
+        elif fonts_dir_signature is not None:
+            with os.scandir(self.fonts_dir) as entries:
+                dir_names = [entry.name for entry in entries if entry.is_dir()]
+        for dir_name in set(self.font_dir_names()) - set(dir_names):
+            self.index.remove(dir_name)
+        for dir_name in dir_names:
+            font = self.load_font(dir_name)
+            if font:
+                self.found_fonts[font.font_family.lower()] = font
+        self.index.set(self.scanned_key, fonts_dir_signature)
+        self.is_index_complete = True
+        self.index.save()
 
     def find_font(self, font_family: str) -> FontInfo | None:
-        return self.fonts.get(font_family.lower())
+        family = font_family.lower()
+        font = self.found_fonts.get(family)
+        if font or self.is_index_complete:
+            return font
+        for dir_name in self.font_dir_names():
+            if self.index.get(dir_name)["font"]["font-family"].lower() == family:
+                font = self.load_font(dir_name)
+                if font and font.font_family.lower() == family:
+                    self.found_fonts[family] = font
+                    self.index.save()
+                    return font
+        self.update_index()
+        return self.found_fonts.get(family)
+
+    @property
+    def fonts(self) -> dict[str, FontInfo]:
+        """
+        All the fonts, by (lower case) family name
+        """
+        if not self.is_index_complete:
+            self.update_index()
+        return self.found_fonts
 
-    def sync_font(self, font: FontInfo, target_dir: str, always_copy=False) -> bool:
+    def font_paths(self, font: FontInfo, target_dir: str) -> (str, str, str | None, str | None):
+        """
+        Returns the paths of the font file, the converted fonts (without extension) and any txt file (and its target)
+        """
         otf_path = os.path.join(font.font_dir, font.otf_file)
         target_base_path = os.path.join(target_dir, font.slug)
+        if font.txt_file:
+            return otf_path, target_base_path, os.path.join(font.font_dir, font.txt_file), \
+                os.path.join(target_dir, font.txt_file)
+        return otf_path, target_base_path, None, None
+
+    def is_synced(self, font: FontInfo, target_dir: str, manifest: SyncManifest | None = None,
+                  subset_chars: str | None = None) -> bool:
+        """
+        Checks if the woff and woff2 (and any txt file) in target_dir are newer than the font - or, with a manifest,
+        if the contents of all of them (and the characters they are subset to) are unchanged since they were last
+        synced
+        """
+        otf_path, target_base_path, txt_source_path, txt_target_path = self.font_paths(font, target_dir)
         woff_path = f"{target_base_path}.woff"
         woff2_path = f"{target_base_path}.woff2"
+        if manifest:
+            digest = subset_digest(subset_chars)
+            return manifest.is_up_to_date(woff_path, [otf_path], digest) and \
+                manifest.is_up_to_date(woff2_path, [otf_path], digest) and \
+                (txt_source_path is None or manifest.is_up_to_date(txt_target_path, [txt_source_path]))
+        return not needs_sync(otf_path, woff_path) and \
+            not needs_sync(otf_path, woff2_path) and \
+            not(txt_source_path is not None and needs_sync(txt_source_path, txt_target_path))
 
-        if font.txt_file:
-            txt_source_path = os.path.join(font.font_dir, font.txt_file)
-            txt_target_path = os.path.join(target_dir, font.txt_file)
+    def sync_font(self, font: FontInfo, target_dir: str, always_copy=False, manifest: SyncManifest | None = None,
+                  font_cache: BlobCache | None = None) -> bool:
+        """
+        Converts the font to woff and woff2 (and copies any txt file) into target_dir, unless already synced
+        (see is_synced). Conversions are reused from font_cache, if given
+        """
+        return self.sync_fonts([font], target_dir, always_copy, manifest, workers=1, font_cache=font_cache) == 1
+
+    def sync_fonts(self, fonts: typing.Iterable[FontInfo], target_dir: str, always_copy=False,
+                   manifest: SyncManifest | None = None, workers: int | None = None,
+                   font_cache: BlobCache | None = None, subset_chars: str | None = None) -> int:
+        """
+        As sync_font() for each of the fonts, returning how many were synced.
+        Conversions are spread across a pool of (up to workers) processes.
+        If subset_chars is given (e.g. from used_characters(), once the site has been generated) the fonts are cut
+        down to just those characters. That needs a manifest, so they are only subset again if the characters change
+        """
+        if subset_chars is not None and manifest is None:
+            raise Exception("Subsetting fonts needs a SyncManifest, to tell when the characters used have changed")
+        fonts = [font for font in fonts
+                 if always_copy or not self.is_synced(font, target_dir, manifest, subset_chars)]
+        if not fonts:
+            return 0
+        ensure_dirs(target_dir)
+        conversions = []
+        for font in fonts:
+            otf_path, target_base_path, _, _ = self.font_paths(font, target_dir)
+            print(f"syncing {otf_path} into {target_base_path}")
+            conversions.append((otf_path, target_base_path))
+
+        if len(conversions) == 1 or workers == 1:
+            for otf_path, target_base_path in conversions:
+                convert_font(otf_path, target_base_path, font_cache, subset_chars)
         else:
-            txt_source_path = None
-            txt_target_path = None
+            with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(conversions))) as executor:
+                for converting in [executor.submit(convert_font, otf_path, target_base_path, font_cache, subset_chars)
+                                   for otf_path, target_base_path in conversions]:
+                    converting.result()
 
-        needs_update = always_copy
-        if not always_copy and \
-                not needs_sync(otf_path, woff_path) and \
-                not needs_sync(otf_path, woff2_path) and \
-                not(txt_source_path is not None and needs_sync(txt_source_path, txt_target_path)):
-            return False
+        for font in fonts:
+            otf_path, target_base_path, txt_source_path, txt_target_path = self.font_paths(font, target_dir)
+            if txt_source_path:
+                shutil.copy2(txt_source_path, txt_target_path)
+            if manifest:
+                digest = subset_digest(subset_chars)
+                manifest.record(f"{target_base_path}.woff", [otf_path], digest=digest)
+                manifest.record(f"{target_base_path}.woff2", [otf_path], digest=digest)
+                if txt_source_path:
+                    manifest.record(txt_target_path, [txt_source_path], is_copy=True)
+        return len(fonts)
 
-        print(f"syncing {otf_path} into {target_base_path}")
-        ensure_dirs(target_dir)
-        otf_font = TTFont(otf_path)
-        otf_font.flavor = "woff2"
-        otf_font.save(woff2_path)
-        otf_font.flavor = "woff"
-        otf_font.save(woff_path)
-        if txt_source_path:
-            shutil.copy2(txt_source_path, txt_target_path)
-        return True
+
+def used_characters(output_dir: str, always_include: str = printable_ascii) -> str:
+    """
+    Returns all the characters in the text of the html files under output_dir (plus always_include, for any text
+    that's added by scripts, say), for subsetting fonts to.
+    This is across the whole site, rather than per font, as telling which font any text is shown in would need the
+    whole of the CSS to be applied
+    """
+    with timed("font character scan"):
+        chars = set(always_include)
+        for root, _, files in os.walk(output_dir):
+            for file in files:
+                if file.endswith(".html"):
+                    with open(os.path.join(root, file), "r", encoding="utf-8", errors="replace") as f:
+                        chars.update(html.unescape(non_text_parser.sub(" ", f.read())))
+        return "".join(sorted(chars))
+
+
+def subset_digest(subset_chars: str | None) -> str | None:
+    return None if subset_chars is None else hashlib.sha256(subset_chars.encode()).hexdigest()
+
+
+def font_cache_key(font_hash: str, flavor: str, subset_chars: str | None = None) -> str:
+    return hashlib.sha256(f"{fontTools.version}\n{font_hash}\n{flavor}\n{subset_digest(subset_chars)}".encode()) \
+        .hexdigest()
+
+
+def convert_font(otf_path: str, target_base_path: str, font_cache: BlobCache | None = None,
+                 subset_chars: str | None = None):
+    """
+    Converts the font to woff2 and woff (as target_base_path with those extensions) - subset to just subset_chars,
+    if given.
+    With a font_cache, conversions are looked up by the font's content hash (and flavour and subset), so a font
+    that's been converted before - by any build using the same cache - isn't converted again
+    """
+    font_hash = hash_file(otf_path) if font_cache else None
+    otf_font = None
+    for flavor in ["woff2", "woff"]:
+        key = font_cache_key(font_hash, flavor, subset_chars) if font_cache else None
+        converted = font_cache.get(key) if font_cache else None
+        if converted is None:
+            with timed("font conversion"):
+                if otf_font is None:
+                    otf_font = TTFont(otf_path)
+                    if subset_chars is not None:
+                        subsetter = fontTools.subset.Subsetter()
+                        subsetter.populate(text=subset_chars)
+                        subsetter.subset(otf_font)
+                otf_font.flavor = flavor
+                buffer = io.BytesIO()
+                otf_font.save(buffer)
+                converted = buffer.getvalue()
+            if font_cache:
+                font_cache.put(key, converted)
+        with open(f"{target_base_path}.{flavor}", "wb") as f:
+            f.write(converted)
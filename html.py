@@ -1,9 +1,28 @@
-from pykyll.utils import exhaustive_replace, truncate_text_by_sentence
+from pykyll.instrumentation import timed
+from pykyll.utils import truncate_prefix_by_sentence, Replacer
+import math
 import re
+import threading
+import typing
+from dataclasses import dataclass
+from functools import lru_cache, cached_property
+
+import bleach
 import html_text
+import lxml.etree
+import lxml.html
+from bleach.linkifier import URL_RE
 
-img_parser = re.compile(r'.*?<img (.*?)\s*class\s*=\s*\"(.*?)\"(.*?)>.*', re.DOTALL)
-img_src_parser = re.compile(r'.*?src\s*=\s*\"(.*?)\".*', re.DOTALL)
+# Characters that bleach may escape, normalise or remove. Text without any of these (and, for linkify, without URLs)
+# comes back from bleach unchanged
+bleach_sensitive_chars = re.compile('[<>&\r\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ud800-\udfff\ufdd0-\ufdef\ufffe\uffff]')
+# As used by html_text.extract_text() to decide on the spacing between pieces of text.
+# Text extraction here follows html_text's internals (not its public API), so relies on the version pinned in
+# requirements.txt - test_html.py checks that the two still give the same text
+whitespace_parser = re.compile(r'\s+')
+has_trailing_whitespace = re.compile(r'\s$').search
+has_punctuation_after = re.compile(r'^[,:;.!?")]').search
+has_open_bracket_before = re.compile(r'\($').search
 
 
 def strip_tag(html: str, tag_name: str) -> str:
@@ -59,6 +78,31 @@ url_replacements = {
     '#': ""}
 
 
+# slugify() gives the same result as running exhaustive_replace() with url_replacements (then collapsing dots and
+# dashes), but in a fixed number of steps. Within the first pass of exhaustive_replace every rule is applied once,
+# in table order, which is what the steps below replicate. After that pass the only patterns that can remain are runs
+# of dots that were brought together by later deletions, so a second pass only has to deal with those.
+# If url_replacements changes, these must change with it (the property tests in test_html.py compare the two)
+slug_tags = ["<em>", "</em>", "<code>", "</code>"]
+slug_separators = str.maketrans({"\t": "-", "\n": "-", "\r": "-", " ": "-", "/": "-", "\\": "-"})
+slug_punctuation = str.maketrans({"+": "p", ";": "-", ":": "", ",": "-"})
+slug_removals = str.maketrans({
+    "'": "", '"': "", "`": "", "<": "", ">": "", "!": "", "*": "", "?": "",
+    "&": "and", "%": "pc",
+    "(": "", ")": "", "[": "", "]": "", "{": "", "}": ""})
+dots_parser = re.compile(r"\.+")
+dashes_parser = re.compile(r"-{2,}")
+
+
+def remove_dot_runs(text: str) -> str:
+    """
+    What replacing "..." then ".." (each with nothing) does to each run of dots: leaves one dot if the run length
+    is one more than a multiple of three, otherwise nothing
+    """
+    return dots_parser.sub(lambda m: "." if len(m.group()) % 3 == 1 else "", text)
+
+
+@lru_cache(maxsize=4096)
 def slugify(text: str) -> str:
     """
     Converts raw text into a string that is valid as part of a URL.
@@ -67,46 +111,215 @@ def slugify(text: str) -> str:
     """
     text = text.encode('ascii', 'ignore').decode("utf-8")
     text = text.strip().lower()
-    text = exhaustive_replace(text, url_replacements)
 
-    # Do these separately so multiple dots and dashes are collapsed first
-    text = exhaustive_replace(text, {".": "-"})
-    text = exhaustive_replace(text, {"--": "-"})
+    if "<" in text:
+        for tag in slug_tags:
+            text = text.replace(tag, "")
+    text = text.translate(slug_separators)
+    if "&" in text:
+        text = text.replace("&amp;", "and")
+    text = text.translate(slug_punctuation)
+    if "." in text:
+        text = remove_dot_runs(text)
+    text = text.translate(slug_removals)
+    if "#" in text:
+        text = text.replace("c#", "csharp").replace("f#", "fsharp").replace("#", "")
+    if "." in text:
+        # Dots may have been brought together by the removals
+        text = remove_dot_runs(text).replace(".", "-")
+
+    text = dashes_parser.sub("-", text)
     return text.strip("-")
 
 
+attribute_safe_replacer = Replacer({
+    '"': "'",
+    "\n": " ",
+    "\t": " ",
+    "  ": " ",
+    "!": ".",
+    "?": "."})
+
+
+def parse_html(html: str) -> lxml.html.HtmlElement:
+    """
+    Parses html, then removes scripts, styles etc., in the same way as html_text.extract_text() does
+    """
+    tree = html_text.parse_html(html)
+    try:
+        return html_text.cleaner.clean_html(tree)
+    except AssertionError:
+        return tree  # As html_text does (see https://bugs.launchpad.net/lxml/+bug/1838497)
+
+
+def extract_text_pieces(tree: lxml.html.HtmlElement) -> typing.Iterator[str]:
+    """
+    Yields the text that html_text.extract_text() would extract from the (parsed) html, a piece at a time, so callers
+    that only need the start of it can stop early. Joined together (then stripped) the pieces give the same text
+    """
+    newline = object()
+    double_newline = object()
+    previous = double_newline  # newline, double_newline or the previous (unnormalised) text
+
+    for event, element in lxml.etree.iterwalk(tree, events=("start", "end")):
+        if previous is not double_newline:
+            if element.tag in html_text.DOUBLE_NEWLINE_TAGS:
+                yield "\n" if previous is newline else "\n\n"
+                previous = double_newline
+            elif element.tag in html_text.NEWLINE_TAGS:
+                if previous is not newline:
+                    yield "\n"
+                previous = newline
+
+        raw_text = element.text if event == "start" else element.tail if element is not tree else None
+        text = whitespace_parser.sub(" ", raw_text.strip()) if raw_text else ""
+        if text:
+            if previous is newline or previous is double_newline or \
+                    (not has_trailing_whitespace(previous) and
+                     (has_punctuation_after(text) or has_open_bracket_before(previous))):
+                yield text
+            else:
+                yield " " + text
+            previous = raw_text
+
+
+@dataclass
+class HtmlImage:
+    src: str | None
+    classes: list[str]
+
+
+class HtmlAnalysis:
+    """
+    Parses html just once for its text (extracted only as far as is needed), images and first h1
+    """
+    def __init__(self, html: str):
+        self.tree = parse_html(html)
+        self.text_pieces = []
+        self.text_length = 0
+        self.unread_text_pieces = extract_text_pieces(self.tree)
+
+    def read_text(self, length: int | float) -> bool:
+        """
+        Extracts more text, until there is at least length of it. Returns False if there wasn't that much
+        """
+        while self.text_length < length:
+            piece = next(self.unread_text_pieces, None)
+            if piece is None:
+                return False
+            self.text_pieces.append(piece)
+            self.text_length += len(piece)
+        return True
+
+    @property
+    def text(self) -> str:
+        """
+        All of the text, as html_text.extract_text() would give it
+        """
+        self.read_text(math.inf)
+        return "".join(self.text_pieces).strip()
+
+    def description(self, attribute_safe=True, allow_sentence_to_be_cut=True, wrap_in_p_tags=False, max_length=300) \
+            -> str:
+        """
+        The text, truncated (by sentence) to max_length - see make_description()
+        """
+        check_length = max_length * 2
+        while True:
+            has_more_text = self.read_text(check_length)
+            text = "".join(self.text_pieces)
+            if attribute_safe:
+                # remove anything that shouldn't be in an attribute.
+                # (Replacing the start of some text gives the start of the text replaced, so truncating it still works)
+                text = attribute_safe_replacer.replace(text)
+            truncated, is_final = truncate_prefix_by_sentence(text.strip(), max_length,
+                                                              allow_sentence_to_be_cut=allow_sentence_to_be_cut)
+            if is_final or not has_more_text:
+                break
+            check_length = self.text_length * 2 + 1
+
+        if wrap_in_p_tags:
+            lines = truncated.splitlines()
+            return "\n".join(f"<p>{line}</p>" for line in lines)
+        else:
+            return truncated
+
+    @cached_property
+    def images(self) -> list[HtmlImage]:
+        return [HtmlImage(img.get("src"), img.get("class", "").split()) for img in self.tree.iter("img")]
+
+    @cached_property
+    def first_h1(self) -> str | None:
+        h1 = next(self.tree.iter("h1"), None)
+        return None if h1 is None else h1.text_content().strip()
+
+    def find_image_with_class(self, class_name: str) -> str | None:
+        """
+        Finds the image file of the first img tag with a given class name
+        """
+        for image in self.images:
+            if class_name in image.classes and image.src is not None:
+                return image.src
+        return None
+
+
 def make_description(html: str, attribute_safe=True, allow_sentence_to_be_cut=True, wrap_in_p_tags=False, max_length=300) -> str:
-    # soup = BeautifulSoup(html, features="html.parser")
-    # text = soup.get_text().strip("/n").strip()
-
-    text = html_text.extract_text(html)
-
-    if attribute_safe:
-        # remove anything that shouldn't be in an attribute
-        text = exhaustive_replace(text, {
-            '"': "'",
-            "\n": " ",
-            "\t": " ",
-            "  ": " ",
-            "!": ".",
-            "?": "."})
-    truncated = truncate_text_by_sentence(text.strip(), max_length, allow_sentence_to_be_cut=allow_sentence_to_be_cut)
-    if wrap_in_p_tags:
-        lines = truncated.splitlines()
-        return "\n".join(f"<p>{line}</p>" for line in lines)
-    else:
-        return truncated
+    """
+    Extracts text from html, truncated (by sentence) to max_length.
+    Only as much text is extracted as is needed to decide where to truncate
+    """
+    return HtmlAnalysis(html).description(attribute_safe, allow_sentence_to_be_cut, wrap_in_p_tags, max_length)
 
 
 def find_image_with_class(html: str, class_name: str) -> str | None:
     """
     Finds an image file within an img tag with a given class name
     """
-    for img_match in img_parser.finditer(html):
-        classes = img_match.group(2).split(" ")
-        for cls in classes:
-            if cls == class_name:
-                img_attrs = img_match.group(1) + " " + img_match.group(3)
-                if m := img_src_parser.match(img_attrs):
-                    return m.group(1)
-    return None
+    return HtmlAnalysis(html).find_image_with_class(class_name)
+
+
+bleachers = threading.local()
+
+
+def get_cleaner(tags: list[str]) -> bleach.Cleaner:
+    """
+    Returns a Cleaner for the allowed tags - set up once per thread (they are not thread safe)
+    """
+    pool = getattr(bleachers, "cleaners", None)
+    if pool is None:
+        pool = bleachers.cleaners = {}
+    key = tuple(tags)
+    cleaner = pool.get(key)
+    if cleaner is None:
+        cleaner = pool[key] = bleach.Cleaner(tags=tags)
+    return cleaner
+
+
+def get_linker() -> bleach.Linker:
+    """
+    Returns a Linker, set up once per thread
+    """
+    linker = getattr(bleachers, "linker", None)
+    if linker is None:
+        linker = bleachers.linker = bleach.Linker()
+    return linker
+
+
+def clean_html(text: str, tags: list[str]) -> str:
+    """
+    Equivalent to bleach.clean(text, tags=tags), but reusing the Cleaner, and skipping it for plain text
+    """
+    if not bleach_sensitive_chars.search(text):
+        return text
+    with timed("bleach clean"):
+        return get_cleaner(tags).clean(text)
+
+
+def linkify_html(text: str) -> str:
+    """
+    Equivalent to bleach.linkify(text), but reusing the Linker, and skipping it for plain text without URLs
+    """
+    if not bleach_sensitive_chars.search(text) and not URL_RE.search(text):
+        return text
+    with timed("bleach linkify"):
+        return get_linker().linkify(text)
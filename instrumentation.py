@@ -0,0 +1,103 @@
+import contextlib
+import json
+import threading
+import time
+from dataclasses import dataclass, asdict
+
+
+@dataclass
+class StageTiming:
+    calls: int = 0
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+
+
+enabled: bool = False
+stage_timings: dict[str, StageTiming] = {}
+timings_lock = threading.Lock()
+active = threading.local()
+null_timer = contextlib.nullcontext()
+
+
+def enable_instrumentation(enable: bool = True):
+    """
+    Turns timing of build stages on or off. While off, timed() costs only a flag check.
+    Work done in other processes (e.g. load_posts_parallel) is not included
+    """
+    global enabled
+    enabled = enable
+
+
+def reset_instrumentation():
+    with timings_lock:
+        stage_timings.clear()
+
+
+class StageTimer:
+    """
+    Adds the wall and CPU time taken within it to the named stage.
+    Re-entering a stage that is already being timed (e.g. by recursion) is not counted again
+    """
+    __slots__ = ["name", "nested", "wall_start", "cpu_start"]
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        stages = getattr(active, "stages", None)
+        if stages is None:
+            stages = active.stages = set()
+        self.nested = self.name in stages
+        if not self.nested:
+            stages.add(self.name)
+            self.cpu_start = time.thread_time()
+            self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.nested:
+            return
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.thread_time() - self.cpu_start
+        active.stages.discard(self.name)
+        with timings_lock:
+            timing = stage_timings.get(self.name)
+            if timing is None:
+                timing = stage_timings[self.name] = StageTiming()
+            timing.calls += 1
+            timing.wall_time += wall_time
+            timing.cpu_time += cpu_time
+
+
+def timed(stage: str):
+    """
+    Returns a context manager that times the stage, if instrumentation is enabled
+    """
+    if not enabled:
+        return null_timer
+    return StageTimer(stage)
+
+
+def instrumentation_report() -> dict[str, dict]:
+    """
+    Returns the timings for each stage, slowest (by wall time) first
+    """
+    with timings_lock:
+        timings = sorted(stage_timings.items(), key=lambda item: item[1].wall_time, reverse=True)
+        return {name: asdict(timing) for name, timing in timings}
+
+
+def write_instrumentation_report(path: str):
+    with open(path, "w") as f:
+        json.dump(instrumentation_report(), f, indent=4)
+
+
+def instrumentation_summary(top_n: int = 10) -> str:
+    """
+    Returns a table of the top_n slowest stages.
+    Times for stages that contain other stages (e.g. templates rendering markdown) include those stages' times
+    """
+    lines = [f"{'stage':<50} {'calls':>8} {'wall (s)':>10} {'cpu (s)':>10}"]
+    for name, timing in list(instrumentation_report().items())[:top_n]:
+        lines.append(f"{name[:50]:<50} {timing['calls']:>8} {timing['wall_time']:>10.3f} {timing['cpu_time']:>10.3f}")
+    return "\n".join(lines)
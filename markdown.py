@@ -1,8 +1,34 @@
+import hashlib
+import inspect
+import json
+import threading
+
 import markdown
 import bleach
 
 from pykyll.allowed_tags import allowed_tags_with_links, allowed_tags
-from pykyll.html import strip_p_tag
+from pykyll.cache import BlobCache
+from pykyll.html import strip_p_tag, clean_html, linkify_html
+from pykyll.instrumentation import timed
+
+
+converters = threading.local()
+
+
+def get_markdown_converter(extensions: tuple[str, ...] = (), output_format='html') -> markdown.Markdown:
+    """
+    Returns a Markdown converter for the extensions and output format, reset and ready to convert.
+    Converters are pooled per thread (they are not thread safe), so extensions are only loaded and set up once
+    """
+    pool = getattr(converters, "pool", None)
+    if pool is None:
+        pool = converters.pool = {}
+    key = (extensions, output_format)
+    converter = pool.get(key)
+    if converter is None:
+        converter = markdown.Markdown(extensions=list(extensions), output_format=output_format)
+        pool[key] = converter
+    return converter.reset()
 
 
 def render_markdown(
@@ -15,10 +41,12 @@ def render_markdown(
     if not text:
         return ""
 
-    extensions = ['extra']
     if embedded_code:
-        extensions.append('fenced_code')
-    html = markdown.markdown(text, extensions=extensions, output_format='html')
+        extensions = ('extra', 'fenced_code')
+    else:
+        extensions = ('extra',)
+    with timed("markdown"):
+        html = get_markdown_converter(extensions).convert(text)
     if strip_outer_p_tag:
         html = strip_p_tag(html)
     if clean:
@@ -32,9 +60,9 @@ def render_markdown(
             for e in remove_elements:
                 tags.remove(e)
 
-        html = bleach.clean(html, tags=tags)
+        html = clean_html(html, tags)
     if linkify:
-        return bleach.linkify(html)
+        return linkify_html(html)
     else:
         return html
 
@@ -42,4 +70,39 @@ def render_markdown(
 def read_markdown(markdown_path: str) -> str:
     with open(markdown_path, 'r') as f:
         md = f.read()
-    return markdown.markdown(md)
+    return get_markdown_converter(output_format='xhtml').convert(md)
+
+
+class MarkdownCache:
+    """
+    A persistent cache of rendered markdown, keyed by a hash of the markdown source and the rendering options
+    (and the versions of the libraries that do the rendering).
+    Returns the html, along with its SHA-256, without invoking markdown on a hit
+    """
+    options_signature = inspect.signature(render_markdown)
+
+    def __init__(self, directory: str, max_entries: int = 10000):
+        self.blobs = BlobCache(directory, max_entries)
+
+    @staticmethod
+    def make_key(text: str, **options) -> str:
+        arguments = MarkdownCache.options_signature.bind(text, **options)
+        arguments.apply_defaults()
+        del arguments.arguments["text"]
+        config = json.dumps([markdown.__version__, bleach.__version__, arguments.arguments], sort_keys=True)
+        return hashlib.sha256(f"{config}\n{text}".encode()).hexdigest()
+
+    def render(self, text: str, **options) -> (str, str):
+        """
+        Renders markdown text (with the same options as render_markdown()), returning the html and its SHA-256
+        """
+        key = self.make_key(text, **options)
+        data = self.blobs.get(key)
+        if data is not None:
+            html_hash, html = data.decode().split("\n", 1)
+            return html, html_hash
+
+        html = render_markdown(text, **options)
+        html_hash = hashlib.sha256(html.encode()).hexdigest()
+        self.blobs.put(key, f"{html_hash}\n{html}".encode())
+        return html, html_hash
@@ -0,0 +1,88 @@
+import math
+import os
+from datetime import datetime
+
+from pykyll.blog_builder import PostMetadata
+from pykyll.html import slugify
+from pykyll.templater import Templater
+
+
+class TagIndex:
+    """
+    Groups posts by tag, built once from the post metadata.
+    Tags with the same slug (e.g. "C++" and "c++") would have the same pages, so are grouped together - under
+    whichever spelling is used most.
+    Posts for each tag are ordered newest first
+    """
+    def __init__(self, all_metadata: list[PostMetadata]):
+        self.posts_by_slug: dict[str, list[PostMetadata]] = {}
+        spellings: dict[str, dict[str, int]] = {}
+        for metadata in all_metadata:
+            for tag in metadata.tags or []:
+                slug = slugify(tag)
+                counts = spellings.setdefault(slug, {})
+                counts[tag] = counts.get(tag, 0) + 1
+                posts = self.posts_by_slug.setdefault(slug, [])
+                if not posts or posts[-1] is not metadata:
+                    posts.append(metadata)
+        self.tags_by_slug = {slug: min(counts, key=lambda tag: (-counts[tag], tag))
+                             for slug, counts in spellings.items()}
+        for posts in self.posts_by_slug.values():
+            posts.sort(key=lambda metadata: metadata.timestamp or datetime.min, reverse=True)
+
+    @property
+    def tags(self) -> list[str]:
+        return sorted(self.tags_by_slug.values(), key=str.lower)
+
+    @property
+    def counts(self) -> dict[str, int]:
+        return {tag: len(self.posts_for(tag)) for tag in self.tags}
+
+    def posts_for(self, tag: str) -> list[PostMetadata]:
+        """
+        The posts with the tag - or any other tag with the same slug
+        """
+        return self.posts_by_slug.get(slugify(tag), [])
+
+
+def tag_page_filename(tag: str, page: int, subdir: str = "tags") -> str:
+    """
+    The first page for a tag is the index of the tag's directory, then page-2.html, page-3.html etc
+    """
+    if page == 1:
+        return os.path.join(subdir, slugify(tag), "index.html")
+    else:
+        return os.path.join(subdir, slugify(tag), f"page-{page}.html")
+
+
+def build_tag_pages(templater: Templater,
+                    tag_index: TagIndex,
+                    template_name: str,
+                    posts_per_page: int = 20,
+                    subdir: str = "tags",
+                    **kwargs) -> int:
+    """
+    Renders paginated archive pages for each tag.
+    Passed in to the template are the tag, its (newest first) posts for the page, page (from 1), page_count, post_count,
+    and previous_page and next_page (filenames, or None) - as well as any additional kwargs.
+    With a build graph in the templater, only pages whose posts (or their metadata) have changed are re-rendered.
+    Returns the number of pages rendered
+    """
+    rendered = 0
+    for tag in tag_index.tags:
+        posts = tag_index.posts_for(tag)
+        page_count = max(math.ceil(len(posts) / posts_per_page), 1)
+        for page in range(1, page_count + 1):
+            if templater.render_to_file(
+                    template_name,
+                    tag_page_filename(tag, page, subdir),
+                    tag=tag,
+                    posts=posts[(page - 1) * posts_per_page:page * posts_per_page],
+                    page=page,
+                    page_count=page_count,
+                    post_count=len(posts),
+                    previous_page=tag_page_filename(tag, page - 1, subdir) if page > 1 else None,
+                    next_page=tag_page_filename(tag, page + 1, subdir) if page < page_count else None,
+                    **kwargs):
+                rendered += 1
+    return rendered
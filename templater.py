@@ -1,15 +1,21 @@
+import hashlib
 import os
+import re
 import typing as t
+from collections import OrderedDict
 
-import bleach
-from jinja2 import FileSystemLoader, Environment, nodes, TemplateAssertionError
+from jinja2 import FileSystemLoader, Environment, nodes, TemplateAssertionError, meta, FileSystemBytecodeCache, \
+    Template
 from jinja2.ext import Extension
 from jinja2.nodes import CallBlock, Const
 
 from .allowed_tags import allowed_tags, allowed_tags_with_links
 from .markdown import render_markdown
+from .html import clean_html, linkify_html
+from .instrumentation import timed
 from .site import Site
-from .fileutils import ensure_parent_dirs
+from .build_graph import BuildGraph, Untrackable, make_digest
+from .fileutils import ensure_parent_dirs, file_signature
 
 
 class TemplateError(TemplateAssertionError):
@@ -39,14 +45,14 @@ def markdown_filter(markdown: str) -> str:
 def clean_for_attribute(text: str) -> str:
     if not text:
         return ""
-    return bleach.clean(text, tags=allowed_tags).replace('"', "&quot;").replace("'", "&apos;")
+    return clean_html(text, allowed_tags).replace('"', "&quot;").replace("'", "&apos;")
 
 
 def clean_for_block(text: str) -> str:
     if not text:
         return ""
-    html = bleach.clean(text, tags=allowed_tags_with_links)
-    return bleach.linkify(html)
+    html = clean_html(text, allowed_tags_with_links)
+    return linkify_html(html)
 
 
 def template_error(text: str) -> str:
@@ -84,28 +90,166 @@ def get_string_based_environment(filters=None) -> Environment:
     return env
 
 
-def get_file_based_environment(filters=None) -> Environment:
-    loader = FileSystemLoader(".")
-    env = RelEnvironment(loader=loader,
-                         trim_blocks=True,
-                         lstrip_blocks=True)
-    add_filters(env, filters)
+# Environments are kept for the most recently used filters (and working directories). Callers usually pass the same
+# filters each time, but may build them afresh (e.g. as lambdas) on each call, so these are bounded
+file_based_environments: OrderedDict[tuple, Environment] = OrderedDict()
+string_based_environments: OrderedDict[tuple, Environment] = OrderedDict()
+max_environments = 32
+template_bytecode_cache: FileSystemBytecodeCache | None = None
+
+
+def set_template_bytecode_cache(directory: str | None):
+    """
+    Sets (or, with None, clears) a directory where compiled templates are cached between builds
+    """
+    global template_bytecode_cache
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        template_bytecode_cache = FileSystemBytecodeCache(directory)
+    else:
+        template_bytecode_cache = None
+    for env in file_based_environments.values():
+        env.bytecode_cache = template_bytecode_cache
+
+
+def filters_key(filters) -> tuple:
+    if not filters:
+        return ()
+    # The filters themselves (which compare by identity) rather than their ids, which could be reused once they've gone
+    return tuple((name, filters[name]) for name in sorted(filters))
+
+
+def get_cached_environment(environments: OrderedDict[tuple, Environment], key: tuple,
+                           make_environment: t.Callable[[], Environment]) -> Environment:
+    """
+    Returns the environment for the key, making it (and evicting the least recently used, if need be) if it's new
+    """
+    env = environments.get(key)
+    if env is not None:
+        environments.move_to_end(key)
+        return env
+    env = environments[key] = make_environment()
+    if len(environments) > max_environments:
+        environments.popitem(last=False)
     return env
 
 
+def get_file_based_environment(filters=None) -> Environment:
+    """
+    Returns the environment for loading templates relative to the working directory, with the given filters.
+    Environments are kept (see max_environments), so each template is only compiled once
+    """
+    key = (os.getcwd(), filters_key(filters))
+
+    def make_environment() -> Environment:
+        env = RelEnvironment(loader=FileSystemLoader(key[0]),
+                             trim_blocks=True,
+                             lstrip_blocks=True,
+                             bytecode_cache=template_bytecode_cache)
+        add_filters(env, filters)
+        return env
+    return get_cached_environment(file_based_environments, key, make_environment)
+
+
+string_templates: OrderedDict[tuple, Template] = OrderedDict()
+max_string_templates = 1000
+template_delimiters = ["{{", "{%", "{#"]
+newline_parser = re.compile(r"\r\n|\r|\n")
+
+
+def plain_template_text(text: str) -> str:
+    """
+    Returns what Jinja would render for text that contains no template delimiters:
+    the text with newlines normalised and a single trailing newline removed
+    """
+    lines = newline_parser.split(text)
+    if lines[-1] == "":
+        del lines[-1]
+    return "\n".join(lines)
+
+
+def get_string_template(template_as_string: str, filters=None) -> Template:
+    """
+    Returns the compiled template for the string, from a (bounded) cache of recently used ones
+    """
+    key = (hashlib.sha256(template_as_string.encode()).digest(), filters_key(filters))
+    template = string_templates.get(key)
+    if template is not None:
+        string_templates.move_to_end(key)
+        return template
+
+    env = get_cached_environment(string_based_environments, key[1], lambda: get_string_based_environment(filters))
+    template = env.from_string(template_as_string)
+    string_templates[key] = template
+    if len(string_templates) > max_string_templates:
+        string_templates.popitem(last=False)
+    return template
+
+
+def render_string_template(template_as_string: str, filters=None, **kwargs) -> str:
+    if not any(delimiter in template_as_string for delimiter in template_delimiters):
+        return plain_template_text(template_as_string)
+    with timed("template (from string)"):
+        return get_string_template(template_as_string, filters).render(**kwargs)
+
+
 class Templater:
     def __init__(
             self, site: Site,
             templates_root: str,
             email_templates_root: str | None = None,
             filters = None, # Or dict of filters
+            build_graph: BuildGraph | None = None,
             **extra_data):
         self.site = site
         self.templates_root = templates_root
         self.email_templates_root = email_templates_root
         self.extra_data = extra_data
         self.filters = filters
+        self.build_graph = build_graph
+        self.template_dependencies = {}
+
+    @staticmethod
+    def resolve_template_path(directory: str, template_name: str) -> str:
+        """
+        Returns the path of the named template, as the (file based) environment loads it - relative to the working
+        directory where possible
+        """
+        template_path = os.path.normpath(os.path.join(directory, template_name))
+        wd = os.getcwd()
+        if template_path.startswith(wd):
+            template_path = template_path[len(wd)+1:]
+        return template_path
 
+    def template_files(self, template_path: str) -> list[str] | None:
+        """
+        Returns the template file along with all the templates it extends, includes or imports (transitively),
+        or None if any of them are only known at render time
+        """
+        cached = self.template_dependencies.get(template_path)
+        if cached:
+            try:
+                if all(file_signature(path) == signature for path, signature in cached):
+                    return [path for path, _ in cached]
+            except OSError:
+                pass  # One has been deleted, so finding them again reports it (as TemplateNotFound)
+
+        env = get_file_based_environment(self.filters)
+        found = []
+        pending = [template_path]
+        while pending:
+            path = pending.pop()
+            if path in found:
+                continue
+            found.append(path)
+            source, _, _ = env.loader.get_source(env, path)
+            for reference in meta.find_referenced_templates(env.parse(source, path, path)):
+                if reference is None:
+                    return None
+                pending.append(env.join_path(reference, path))
+
+        self.template_dependencies[template_path] = [(path, file_signature(path)) for path in found]
+        return found
 
     @staticmethod
     def render_from_template(
@@ -117,20 +261,17 @@ class Templater:
         Renders the named template and returns the rendered string
         """
         env = get_file_based_environment(filters)
-        template_path = os.path.normpath(os.path.join(directory, template_name))
-        wd = os.getcwd()
-        if template_path.startswith(wd):
-            template_path = template_path[len(wd)+1:]
-        template = env.get_template(template_path)
-        return template.render(**kwargs)
+        template_path = Templater.resolve_template_path(directory, template_name)
+        with timed(f"template {template_path}"):
+            template = env.get_template(template_path)
+            return template.render(**kwargs)
 
     @staticmethod
     def render_from_string_raw(template_as_string: str, filters = None, **kwargs) -> str:
         """
         Renders a template provided as a string and returns the rendered string
         """
-        template = get_string_based_environment(filters).from_string(template_as_string)
-        return template.render(**kwargs)
+        return render_string_template(template_as_string, filters, **kwargs)
 
     def render_from_string(self, template_as_string: str, levels: int = 0, rootdir=None, **kwargs) -> str:
         """
@@ -141,9 +282,10 @@ class Templater:
         if rootdir is None:
             rootdir = "../" * levels
         static_root = os.path.join(rootdir, self.site.static_target_subdir)
-        template = get_string_based_environment(self.filters).from_string(template_as_string)
         args = self.extra_data | kwargs
-        return template.render(
+        return render_string_template(
+            template_as_string,
+            self.filters,
             rootdir=rootdir,
             static_root=static_root,
             site=self.site,
@@ -192,21 +334,44 @@ class Templater:
             template_name: str,
             filename: str,
             page_summary: str | None = None,
-            **kwargs):
+            volatile_args: tuple[str] = (),
+            **kwargs) -> bool:
         """
         Renders the named template to the named file, enriching with additional args
         The page_summary is used as the description of the page for unfurling links. If missing it uses the default
         for the site.
         Also passed in to the template are rootdir, static_root (off rootdir), canonical_url and site, as well as
         any additional kwargs, passed.
+        If there is a build graph, the file is only rendered if any of its inputs (the templates, any posts passed in,
+        the site and the other args - except those named in volatile_args) have changed since it was last rendered.
+        Returns True if the file was rendered
         """
+        path = os.path.join(self.site.output_dir, filename)
+        input_files = set()
+        digest = None
+        if self.build_graph:
+            template_files = self.template_files(Templater.resolve_template_path(self.templates_root, template_name))
+            if template_files is not None:
+                input_files.update(template_files)
+                tracked_args = {name: value for name, value in kwargs.items() if name not in volatile_args}
+                try:
+                    digest = make_digest(
+                        [template_name, page_summary, self.site, self.extra_data, tracked_args],
+                        input_files)
+                except Untrackable:
+                    pass
+            if digest is not None and self.build_graph.is_up_to_date(path, input_files, digest):
+                return False
+
         levels = get_level(filename)
         canonical_url = os.path.join(self.site.public_url, filename)
         rendered = self.render_to_string(template_name, levels, canonical_url, page_summary, **kwargs)
-        path = os.path.join(self.site.output_dir, filename)
         ensure_parent_dirs(path)
         with open(path, 'w') as out_file:
             out_file.write(rendered)
+        if self.build_graph:
+            self.build_graph.record(path, input_files, digest)
+        return True
 
     def render_email(self, template_name, **kwargs):
         if not self.email_templates_root:
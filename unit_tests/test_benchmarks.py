@@ -0,0 +1,10 @@
+from pykyll.benchmarks.run import run_benchmarks
+
+
+def test_benchmarks_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    results = run_benchmarks(str(tmp_path / "site"), post_count=5, repeat=1)
+    assert set(results.keys()) >= {"slugify", "make_description", "load_post_metadata", "Post construction",
+                                   "Templater.render_to_file", "CssProcessor.process", "sync_files"}
+    assert (tmp_path / "site" / "web" / "index.html").exists()
+    assert (tmp_path / "site" / "web" / "css" / "site.css").exists()
@@ -0,0 +1,142 @@
+import os
+from itertools import accumulate
+
+import pytest
+
+from pykyll.blog_builder import load_post_metadata, read_metadata, PostMetadataIndex, load_post_from_metadata, \
+    load_posts_parallel, PostLoadError, read_post, lines_with_offsets, save_dirty_posts, serialize_post, \
+    LazyPost
+
+
+post_text = """<script type="application/json">
+{
+    "guid": "1234",
+    "hash": "abcd",
+    "slug": "a-post",
+    "tags": "one, two",
+    "version": 1
+}
+</script>
+
+# A post
+
+Some content.
+"""
+
+
+def write_post(posts_dir, filename: str, text: str = post_text) -> str:
+    path = os.path.join(posts_dir, filename)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+
+def test_read_metadata(tmp_path):
+    path = write_post(tmp_path, "2023-01-02T10-30.md")
+    metadata = read_metadata(path, "posts")
+    assert metadata.title == "A post"
+    assert metadata.slug == "a-post"
+    assert metadata.guid == "1234"
+    assert metadata.tags == ["one", "two"]
+    assert metadata.timestamp.year == 2023 and metadata.timestamp.minute == 30
+    assert metadata.content_line_no == 11
+    assert not metadata.is_dirty
+
+
+def test_read_post(tmp_path):
+    text = post_text + "more\r\ncontent\u2028with odd line breaks\n"
+    path = write_post(tmp_path, "2023-01-02T10-30.md", text)
+    metadata, content = read_post(path, "posts")
+    assert metadata == read_metadata(path, "posts")
+    assert content == "\nSome content.\nmore\r\ncontent\u2028with odd line breaks\n"
+    assert load_post_from_metadata(metadata).md_content == content
+
+
+def test_lines_with_offsets():
+    for text in ["", "one", "one\ntwo", "one\r\ntwo\rthree\n\nfour\x0cfive\u2029", "\n\n"]:
+        expected_lines = text.splitlines(keepends=True)
+        lines = list(lines_with_offsets(text))
+        assert [line for line, _ in lines] == expected_lines
+        assert [end for _, end in lines] == list(accumulate(len(line) for line in expected_lines))
+
+
+def test_metadata_index(tmp_path):
+    posts_dir = tmp_path / "posts"
+    posts_dir.mkdir()
+    index_path = str(tmp_path / "index.json")
+    first = write_post(posts_dir, "2023-01-02T10-30.md")
+    second = write_post(posts_dir, "2023-02-02T10-30.md", post_text.replace("A post", "Another post"))
+
+    uncached = load_post_metadata(str(posts_dir), "posts")
+    assert load_post_metadata(str(posts_dir), "posts", index_path=index_path) == uncached
+    # Second time through comes from the index
+    assert load_post_metadata(str(posts_dir), "posts", index_path=index_path) == uncached
+    assert PostMetadataIndex(index_path).get(first, "posts") == uncached[1]
+
+    # Changed posts are re-read, deleted ones dropped
+    write_post(posts_dir, "2023-02-02T10-30.md", post_text.replace("A post", "A changed post!"))
+    os.remove(first)
+    all_metadata = load_post_metadata(str(posts_dir), "posts", index_path=index_path)
+    assert [m.title for m in all_metadata] == ["A changed post!"]
+    assert PostMetadataIndex(index_path).store.keys() == [second]
+
+
+def test_load_posts_parallel(tmp_path):
+    for i in range(1, 6):
+        write_post(tmp_path, f"2023-01-0{i}T10-30.md", post_text.replace("Some content", f"Content {i}"))
+    all_metadata = load_post_metadata(str(tmp_path), "posts")
+
+    posts = load_posts_parallel(all_metadata, workers=2)
+    assert [post.metadata.filename for post in posts] == [m.filename for m in all_metadata]
+    for post, metadata in zip(posts, all_metadata):
+        expected = load_post_from_metadata(metadata)
+        assert post.html_content == expected.html_content
+        assert post.metadata.hash == expected.metadata.hash
+        assert post.__dict__["summary"] == expected.summary
+        assert post.__dict__["description"] == expected.description
+
+    # The failing post reported is the first in the list, not whichever failed first
+    for metadata in all_metadata[1:4]:
+        os.remove(metadata.filename)
+    with pytest.raises(PostLoadError) as e:
+        load_posts_parallel(all_metadata, workers=2)
+    assert e.value.filename == all_metadata[1].filename
+
+
+def test_save_dirty_posts(tmp_path):
+    clean_path = write_post(tmp_path, "2023-01-01T10-30.md")
+    new_path = write_post(tmp_path, "2023-01-02T10-30.md", "# A new post\n\nWith content")
+    posts = [load_post_from_metadata(metadata) for metadata in load_post_metadata(str(tmp_path), "posts")]
+    clean_post = load_post_from_metadata(read_metadata(clean_path, "posts"))
+    with open(clean_path, "wb") as f:
+        f.write(serialize_post(clean_post))
+    posts.append(clean_post)
+    assert all(post.metadata.is_dirty for post in posts)
+
+    # The clean post is dirty (its hash was wrong) but its file already has the right content
+    assert save_dirty_posts(posts, workers=2) == 1
+    assert save_dirty_posts(posts, workers=2) == 0
+    assert sorted(os.listdir(tmp_path)) == ["2023-01-01T10-30.md", "2023-01-02T10-30.md"]
+    metadata = read_metadata(new_path, "posts")
+    assert not metadata.is_dirty
+    assert load_post_from_metadata(metadata).md_content == "\nWith content"
+
+
+def test_lazy_post(tmp_path):
+    path = write_post(tmp_path, "2023-01-01T10-30.md")
+    metadata = read_metadata(path, "posts")
+    post = LazyPost(metadata)
+    os.rename(path, path + ".moved")
+
+    # Nothing is read until needed
+    assert post.metadata is metadata
+    assert not post.is_rendered
+
+    os.rename(path + ".moved", path)
+    expected = load_post_from_metadata(metadata)
+    assert post.description == expected.description
+    assert post.is_rendered
+    assert post.html_content == expected.html_content
+    assert post.summary == expected.summary
+    assert post.metadata == expected.metadata
+    assert post.metadata.is_dirty
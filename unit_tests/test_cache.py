@@ -0,0 +1,21 @@
+import pickle
+
+from pykyll import cache as cache_module
+from pykyll.cache import BlobCache
+
+
+def test_blob_cache_counts_entries_once_per_process(tmp_path, monkeypatch):
+    cache = BlobCache(str(tmp_path / "blobs"), max_entries=3)
+    for _ in range(5):
+        cache.put("a", b"data")
+    assert cache.get("a") == b"data"
+    assert cache_module.entry_counts[cache.directory] == 1
+
+    # A copy, as handed to a process pool, doesn't count the entries again
+    def no_listing(_):
+        raise AssertionError("the cache directory should not be listed")
+    monkeypatch.setattr(cache_module.os, "listdir", no_listing)
+    copy = pickle.loads(pickle.dumps(cache))
+    copy.put("b", b"more data")
+    copy.put("c", b"more data")
+    assert cache_module.entry_counts[cache.directory] == 3
@@ -0,0 +1,120 @@
+import os
+import shutil
+
+from pykyll import css_processor
+from pykyll.css_processor import CssProcessor, ScssCache, find_scss_entries, scss_dependencies
+from pykyll.fileutils import SyncManifest, sync_files
+from pykyll.fonts import AvailableFonts
+
+
+def write(path, text: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_scss_dependencies(tmp_path):
+    css_dir = tmp_path / "css"
+    write(css_dir / "site.scss", "@use 'sass:math';\n@import 'colours', \"layout/grid\";\nbody { color: $main; }\n")
+    write(css_dir / "_colours.scss", "@forward 'base';\n$main: $base;\n")
+    write(css_dir / "_base.scss", "$base: #336699;\n")
+    write(css_dir / "layout" / "_index.scss", "")
+    write(css_dir / "layout" / "grid.scss", ".grid { display: grid; }\n")
+
+    dependencies = scss_dependencies(str(css_dir / "site.scss"))
+    existing = [os.path.relpath(path, css_dir) for path in dependencies if os.path.exists(path)]
+    assert existing == ["site.scss", "_colours.scss", "layout/grid.scss", "_base.scss"]
+    # A colours.scss would be imported instead of the partial, so would change the output
+    assert str(css_dir / "colours.scss") in dependencies
+    assert find_scss_entries(str(css_dir)) == [str(css_dir / "layout" / "grid.scss"), str(css_dir / "site.scss")]
+
+
+def test_scss_is_only_compiled_when_it_or_its_imports_change(tmp_path, monkeypatch):
+    css_dir = tmp_path / "css"
+    write(css_dir / "site.scss", "@import 'colours';\nbody { color: $main; }\n")
+    write(css_dir / "other.scss", "p { margin: 0; }\n")
+    write(css_dir / "_colours.scss", "$main: #336699;\n")
+    fonts = AvailableFonts(str(tmp_path / "fonts"))
+    target_dir = tmp_path / "web" / "css"
+    cache_path = str(tmp_path / "scss-cache.json")
+
+    compiled = []
+    compile_scss = css_processor.compile_scss
+    monkeypatch.setattr(css_processor, "compile_scss", lambda path: compiled.append(path) or compile_scss(path))
+
+    processor = CssProcessor(fonts, str(tmp_path / "web" / "fonts"), ScssCache(cache_path))
+    assert processor.precompile_scss(find_scss_entries(str(css_dir)), workers=1) == 2
+    assert processor.process(str(css_dir / "site.scss"), str(target_dir / "site.scss"))
+    assert processor.process(str(css_dir / "_colours.scss"), str(target_dir / "_colours.scss"))
+    assert "color: #336699" in (target_dir / "site.css").read_text()
+    assert len(compiled) == 2
+    processor.scss_cache.save()
+
+    # Nothing has changed, so nothing is compiled (although the css is still written)
+    os.remove(target_dir / "site.css")
+    processor = CssProcessor(fonts, str(tmp_path / "web" / "fonts"), ScssCache(cache_path))
+    assert processor.precompile_scss(find_scss_entries(str(css_dir))) == 0
+    assert processor.process(str(css_dir / "site.scss"), str(target_dir / "site.scss"))
+    assert "color: #336699" in (target_dir / "site.css").read_text()
+    assert len(compiled) == 2
+
+    # Changing a partial recompiles just the file that imports it
+    write(css_dir / "_colours.scss", "$main: #993366;\n")
+    processor = CssProcessor(fonts, str(tmp_path / "web" / "fonts"), ScssCache(cache_path))
+    assert processor.process(str(css_dir / "site.scss"), str(target_dir / "site.scss"))
+    assert processor.process(str(css_dir / "other.scss"), str(target_dir / "other.scss"))
+    assert "color: #993366" in (target_dir / "site.css").read_text()
+    assert compiled[2:] == [str(css_dir / "site.scss")]
+
+
+def test_precompile_scss_in_parallel(tmp_path):
+    css_dir = tmp_path / "css"
+    for i in range(4):
+        write(css_dir / f"page{i}.scss", f"@import 'colours';\n.page{i} {{ color: $main; }}\n")
+    write(css_dir / "_colours.scss", "$main: #336699;\n")
+    processor = CssProcessor(AvailableFonts(str(tmp_path / "fonts")), str(tmp_path / "web" / "fonts"),
+                             ScssCache(None))
+
+    assert processor.precompile_scss(find_scss_entries(str(css_dir)), workers=2) == 4
+    assert processor.precompile_scss(find_scss_entries(str(css_dir)), workers=2) == 0
+    assert ".page3 {\n  color: #336699; }" in processor.scss_cache.get(str(css_dir / "page3.scss"))
+
+
+def test_scss_is_processed_on_every_sync_with_a_manifest(tmp_path):
+    source, target = tmp_path / "static", tmp_path / "web"
+    write(source / "css" / "site.scss", "@import 'vars';\nbody { font-family: $font; color: $main; }\n")
+    write(source / "css" / "_vars.scss", "$main: #336699;\n$font: 'Body Font', sans-serif;\n")
+    write(tmp_path / "fonts" / "Body Font" / "body.otf", "")
+    manifest_path = str(tmp_path / "manifest.json")
+
+    def sync():
+        manifest = SyncManifest(manifest_path)
+        processor = CssProcessor(AvailableFonts(str(tmp_path / "fonts")), str(target / "fonts"),
+                                 ScssCache(str(tmp_path / "scss-cache.json")))
+        synced = sync_files(str(source), str(target), processor=processor.process, manifest=manifest)
+        manifest.save()
+        processor.scss_cache.save()
+        assert [font.font_family for font in processor.all_required_fonts] == ["Body Font"]
+        return synced
+
+    assert sync() == 2
+    assert "color: #336699" in (target / "css" / "site.css").read_text()
+    # Unchanged, but processed again (from the cache) to collect the fonts it needs
+    assert sync() == 2
+
+    # Editing a partial updates the css of the files that import it
+    write(source / "css" / "_vars.scss", "$main: #993366;\n$font: 'Body Font', sans-serif;\n")
+    assert sync() == 2
+    assert "color: #993366" in (target / "css" / "site.css").read_text()
+
+    # ...and the css is written again if the output has gone
+    shutil.rmtree(target)
+    assert sync() == 2
+    assert "color: #993366" in (target / "css" / "site.css").read_text()
+
+    # ...and removed if the scss is
+    os.remove(source / "css" / "site.scss")
+    manifest = SyncManifest(manifest_path)
+    processor = CssProcessor(AvailableFonts(str(tmp_path / "fonts")), str(target / "fonts"))
+    assert sync_files(str(source), str(target), processor=processor.process, manifest=manifest) == 1
+    assert not os.path.exists(target / "css" / "site.css")
@@ -0,0 +1,174 @@
+import os
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTFont
+
+from pykyll import fonts as fonts_module
+from pykyll.cache import BlobCache
+from pykyll.fileutils import SyncManifest
+from pykyll.fonts import AvailableFonts, used_characters
+
+
+def make_font(path: str, family: str, chars="abcdefghijklmnopqrstuvwxyz "):
+    """
+    Writes a minimal TrueType font, with a (square) glyph for each of chars
+    """
+    glyph_names = [".notdef"] + [f"uni{ord(c):04X}" for c in chars]
+    pen = TTGlyphPen(None)
+    pen.moveTo((0, 0))
+    pen.lineTo((0, 500))
+    pen.lineTo((500, 500))
+    pen.closePath()
+    glyph = pen.glyph()
+
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder(glyph_names)
+    builder.setupCharacterMap({ord(c): f"uni{ord(c):04X}" for c in chars})
+    builder.setupGlyf({name: glyph for name in glyph_names})
+    builder.setupHorizontalMetrics({name: (600, 0) for name in glyph_names})
+    builder.setupHorizontalHeader(ascent=800, descent=-200)
+    builder.setupNameTable({"familyName": family, "styleName": "Regular"})
+    builder.setupOS2()
+    builder.setupPost()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    builder.save(path)
+
+
+def test_sync_font(tmp_path):
+    make_font(str(tmp_path / "fonts" / "Body Font" / "body.ttf"), "Body Font")
+    fonts = AvailableFonts(str(tmp_path / "fonts"))
+    font = fonts.find_font("body font")
+    target_dir = str(tmp_path / "web" / "fonts")
+
+    assert fonts.sync_font(font, target_dir)
+    assert TTFont(os.path.join(target_dir, "body-font.woff2")).flavor == "woff2"
+    assert TTFont(os.path.join(target_dir, "body-font.woff")).flavor == "woff"
+    assert not fonts.sync_font(font, target_dir)
+
+
+def test_sync_font_with_manifest(tmp_path):
+    font_path = str(tmp_path / "fonts" / "Body Font" / "body.ttf")
+    make_font(font_path, "Body Font")
+    fonts = AvailableFonts(str(tmp_path / "fonts"))
+    font = fonts.find_font("body font")
+    target_dir = str(tmp_path / "web" / "fonts")
+    manifest = SyncManifest(str(tmp_path / "manifest.json"))
+
+    assert fonts.sync_font(font, target_dir, manifest=manifest)
+    os.utime(font_path, (2**31, 2**31))
+    assert not fonts.sync_font(font, target_dir, manifest=manifest)
+
+    os.remove(font_path)
+    assert sorted(os.path.basename(path) for path in manifest.remove_orphans(target_dir)) == \
+           ["body-font.woff", "body-font.woff2"]
+    assert os.listdir(target_dir) == []
+
+
+def test_sync_fonts_in_parallel_with_cache(tmp_path, monkeypatch):
+    for family in ["Body Font", "Heading Font", "Code Font"]:
+        make_font(str(tmp_path / "fonts" / family / "font.ttf"), family)
+    fonts = AvailableFonts(str(tmp_path / "fonts"))
+    font_cache = BlobCache(str(tmp_path / "font-cache"))
+
+    first_dir = str(tmp_path / "first")
+    assert fonts.sync_fonts(fonts.fonts.values(), first_dir, workers=2, font_cache=font_cache) == 3
+    assert len(os.listdir(font_cache.directory)) == 6
+    assert fonts.sync_fonts(fonts.fonts.values(), first_dir, workers=2, font_cache=font_cache) == 0
+
+    # A clean build, with the same cache, doesn't need to convert anything
+    def no_conversions(*args):
+        raise AssertionError("Font converted")
+    monkeypatch.setattr(fonts_module, "TTFont", no_conversions)
+    second_dir = str(tmp_path / "second")
+    assert fonts.sync_fonts(fonts.fonts.values(), second_dir, workers=1, font_cache=font_cache) == 3
+    for filename in os.listdir(first_dir):
+        with open(os.path.join(first_dir, filename), "rb") as first, \
+                open(os.path.join(second_dir, filename), "rb") as second:
+            assert first.read() == second.read()
+
+
+def test_subset_fonts_to_used_characters(tmp_path):
+    make_font(str(tmp_path / "fonts" / "Body Font" / "body.ttf"), "Body Font")
+    fonts = AvailableFonts(str(tmp_path / "fonts"))
+    font = fonts.find_font("body font")
+    output_dir = tmp_path / "web"
+    target_dir = str(output_dir / "fonts")
+    manifest = SyncManifest(str(tmp_path / "manifest.json"))
+    os.makedirs(output_dir / "posts")
+    with open(output_dir / "posts" / "index.html", "w") as f:
+        f.write('<html><head><style>.x{}</style></head><body class="q">ab&amp;c<script>var z;</script></body></html>')
+
+    chars = used_characters(str(output_dir), always_include=" ")
+    assert chars == " &abc"
+    assert fonts.sync_fonts([font], target_dir, manifest=manifest, subset_chars=chars) == 1
+    cmap = TTFont(os.path.join(target_dir, "body-font.woff2")).getBestCmap()
+    assert sorted(chr(c) for c in cmap) == [" ", "a", "b", "c"]
+
+    # Only subset again when the characters change
+    assert fonts.sync_fonts([font], target_dir, manifest=manifest, subset_chars=chars) == 0
+    assert fonts.sync_fonts([font], target_dir, manifest=manifest, subset_chars=chars + "d") == 1
+    cmap = TTFont(os.path.join(target_dir, "body-font.woff")).getBestCmap()
+    assert sorted(chr(c) for c in cmap) == [" ", "a", "b", "c", "d"]
+
+
+def test_fonts_are_found_lazily_and_indexed(tmp_path, monkeypatch):
+    fonts_dir = tmp_path / "fonts"
+    make_font(str(fonts_dir / "body" / "body.ttf"), "Body")
+    make_font(str(fonts_dir / "heading" / "heading.ttf"), "Heading")
+    (fonts_dir / "heading" / "heading.yml").write_text("font-family: Big Heading\nfont-weight: bold\nfont-style: normal\n")
+    index_path = str(tmp_path / "font-index.json")
+
+    fonts = AvailableFonts(str(fonts_dir), index_path)
+    assert fonts.find_font("big heading").font_weight == "bold"
+    assert fonts.find_font("missing") is None
+    assert sorted(fonts.fonts) == ["big heading", "body"]
+
+    # With the index, fonts in unchanged directories aren't read again
+    def no_yaml(_):
+        raise Exception("yml should not be read")
+    monkeypatch.setattr(fonts_module.yaml, "safe_load", no_yaml)
+    fonts = AvailableFonts(str(fonts_dir), index_path)
+    font = fonts.find_font("Big Heading")
+    assert (font.font_family, font.font_weight, font.otf_file, font.slug) == \
+           ("Big Heading", "bold", "heading.ttf", "big-heading")
+    assert fonts.found_fonts.keys() == {"big heading"}
+    monkeypatch.undo()
+
+    # ...but changed ones are
+    (fonts_dir / "heading" / "heading.yml").write_text("font-family: Big Heading\nfont-weight: 900\nfont-style: normal\n")
+    os.utime(fonts_dir / "heading" / "heading.yml", ns=(10**18, 10**18))
+    fonts = AvailableFonts(str(fonts_dir), index_path)
+    assert fonts.find_font("big heading").font_weight == 900
+
+    # New fonts are found, and removed ones dropped from the index
+    make_font(str(fonts_dir / "code" / "code.ttf"), "Code")
+    os.remove(fonts_dir / "body" / "body.ttf")
+    os.rmdir(fonts_dir / "body")
+    fonts = AvailableFonts(str(fonts_dir), index_path)
+    assert fonts.find_font("code").font_dir == str(fonts_dir / "code")
+    assert fonts.find_font("body") is None
+    assert sorted(fonts.font_dir_names()) == ["code", "heading"]
+
+    # Families that aren't there only cause unchanged font directories to be checked, not read (or fonts_dir listed)
+    scandir = os.scandir
+
+    def no_listing(path):
+        assert path != str(fonts_dir), "fonts_dir should not be listed"
+        return scandir(path)
+    monkeypatch.setattr(fonts_module.os, "scandir", no_listing)
+    monkeypatch.setattr(fonts_module.yaml, "safe_load", no_yaml)
+    fonts = AvailableFonts(str(fonts_dir), index_path)
+    assert fonts.find_font("sans-serif") is None
+    assert fonts.find_font("serif") is None
+    monkeypatch.undo()
+    make_font(str(fonts_dir / "serif" / "serif.ttf"), "Serif")
+    assert fonts.find_font("serif") is None
+    assert AvailableFonts(str(fonts_dir), index_path).find_font("serif").font_dir == str(fonts_dir / "serif")
+
+    # A family renamed in its yml file is found by its new name (and not its old one)
+    (fonts_dir / "heading" / "heading.yml").write_text("font-family: Title\nfont-weight: bold\nfont-style: normal\n")
+    os.utime(fonts_dir / "heading" / "heading.yml", ns=(2 * 10**18, 2 * 10**18))
+    fonts = AvailableFonts(str(fonts_dir), index_path)
+    assert fonts.find_font("title").font_dir == str(fonts_dir / "heading")
+    assert AvailableFonts(str(fonts_dir), index_path).find_font("big heading") is None
@@ -1,4 +1,13 @@
-from pykyll.html import strip_tag, strip_p_tag, slugify, make_description, find_image_with_class
+import random
+
+import bleach
+import html_text
+
+from pykyll.allowed_tags import allowed_tags, allowed_tags_with_links
+from pykyll.html import strip_tag, strip_p_tag, slugify, make_description, find_image_with_class, clean_html, \
+    linkify_html, url_replacements, attribute_safe_replacer, HtmlAnalysis, HtmlImage
+from pykyll.utils import truncate_text_by_sentence
+from test_utils import reference_replace
 
 
 def test_strip_tags():
@@ -26,6 +35,25 @@ def test_slugify():
     assert slugify("emojis are 👍") == "emojis-are"
 
 
+def reference_slugify(text: str) -> str:
+    text = text.encode('ascii', 'ignore').decode("utf-8")
+    text = text.strip().lower()
+    text = reference_replace(text, url_replacements)
+    text = reference_replace(text, {".": "-"})
+    text = reference_replace(text, {"--": "-"})
+    return text.strip("-")
+
+
+def test_slugify_matches_reference():
+    rng = random.Random(16)
+    pieces = list("".join(url_replacements.keys())) + list(url_replacements.keys()) + \
+        ["<em>", "</em>", "<code>", "</code>", "&amp;", "c", "f", "e", "m", "a", "p", "d", "o", "-", "--", ".", "#",
+         "x", "1", " ", "C#", "F", "é", "👍", "\u2028"]
+    texts = ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 12))) for _ in range(20000)]
+    for text in texts:
+        assert slugify(text) == reference_slugify(text), text
+
+
 def test_make_description():
     assert make_description("<div>Hello <p>there</p> <b>this is bold</b></div>") == "Hello there this is bold"
 
@@ -58,6 +86,33 @@ def test_make_description_truncated():
     assert make_description(text, max_length=10) == "This is a"
 
 
+def random_html(rng: random.Random, depth=0) -> str:
+    words = ["word", "a", "b.", "(x", "y)", ",", ".", "!", "?", '"q"', " ", "\n", "\t", "&amp;", "..", "A sentence."]
+    tags = ["p", "div", "span", "em", "h1", "li", "ul", "br", "script", "style", "pre", "a", "img", "blockquote"]
+    pieces = []
+    for _ in range(rng.randint(0, 6)):
+        if rng.random() < 0.5 or depth > 3:
+            pieces.append(" ".join(rng.choice(words) for _ in range(rng.randint(1, 12))))
+        else:
+            tag = rng.choice(tags)
+            pieces.append(f'<{tag} src="x.png">' if tag in ("br", "img") else f"<{tag}>{random_html(rng, depth+1)}</{tag}>")
+    return "".join(pieces)
+
+
+def test_make_description_matches_extracting_all_text():
+    rng = random.Random(19)
+    for _ in range(500):
+        html = random_html(rng) * rng.randint(1, 10)
+        text = html_text.extract_text(html)
+        assert HtmlAnalysis(html).text == text
+        for max_length in [0, 20, 300]:
+            expected = truncate_text_by_sentence(attribute_safe_replacer.replace(text).strip(), max_length, True)
+            assert make_description(html, max_length=max_length) == expected
+            expected = truncate_text_by_sentence(text, max_length)
+            assert make_description(html, attribute_safe=False, allow_sentence_to_be_cut=False,
+                                    max_length=max_length) == expected
+
+
 def test_image_parser():
     assert find_image_with_class('<img src="xyz.jpg">', "abc") == None
     assert find_image_with_class('<img class="abc" src="xyz.jpg">', "abc") == "xyz.jpg"
@@ -66,3 +121,30 @@ def test_image_parser():
     assert find_image_with_class('<img  src = "xyz.jpg" alt="hello"  class = "abc" >', "abc") == "xyz.jpg"
 
     assert find_image_with_class('<img src="xyz.jpg" class="abc">\n<img src="ijk.png" class="abc">', "abc") == "xyz.jpg"
+    assert find_image_with_class('<img src="xyz.jpg">\n<img class="x abc" src="ijk.png">', "abc") == "ijk.png"
+
+
+def test_html_analysis():
+    analysis = HtmlAnalysis('<h1>The <em>title</em></h1><p>Some text. More text.</p><img class="a b" src="x.png"><img>')
+    assert analysis.first_h1 == "The title"
+    assert analysis.images == [HtmlImage("x.png", ["a", "b"]), HtmlImage(None, [])]
+    assert analysis.find_image_with_class("b") == "x.png"
+    assert analysis.description(max_length=14) == "The title Some"
+    assert analysis.description(max_length=25) == "The title Some text"
+    assert analysis.description(attribute_safe=False, wrap_in_p_tags=True) == \
+           "<p>The title</p>\n<p>Some text. More text.</p>"
+    assert analysis.text == "The title\n\nSome text. More text."
+
+
+def test_clean_and_linkify_match_bleach():
+    texts = ["plain text", "a > b", "<b>bold</b> and <script>bad</script>", "fish & chips", "line\r\nbreak",
+             "nul\x00", "ctrl\x01\x7f\x9f", "see example.com", "mail me@example.com", "http://x", "é 👍 \ufffe",
+             "<a href='https://example.com'>link</a>", "'quotes' \"too\""]
+    rng = random.Random(42)
+    alphabet = "ab .:/@<>&;'\"\r\n\t\x00\x01\x0c\x85\ufffeé"
+    texts += ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20))) for _ in range(500)]
+    texts += ["".join(chr(rng.randint(0, 0x3000)) for _ in range(5)) for _ in range(500)]
+    for text in texts:
+        for tags in [allowed_tags, allowed_tags_with_links]:
+            assert clean_html(text, tags) == bleach.clean(text, tags=tags)
+        assert linkify_html(text) == bleach.linkify(text)
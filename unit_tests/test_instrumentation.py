@@ -0,0 +1,32 @@
+import json
+
+from pykyll.instrumentation import enable_instrumentation, reset_instrumentation, timed, instrumentation_report, \
+    instrumentation_summary, write_instrumentation_report, null_timer
+from pykyll.markdown import render_markdown
+
+
+def test_instrumentation(tmp_path):
+    assert timed("anything") is null_timer
+    reset_instrumentation()
+    enable_instrumentation()
+    try:
+        for _ in range(3):
+            render_markdown("Some <b>text</b>", clean=True)
+        with timed("outer"):
+            with timed("outer"):
+                pass
+    finally:
+        enable_instrumentation(False)
+
+    report = instrumentation_report()
+    assert report["markdown"]["calls"] == 3
+    assert report["bleach clean"]["calls"] == 3
+    assert report["outer"]["calls"] == 1
+    assert report["markdown"]["wall_time"] > 0
+    assert "markdown" in instrumentation_summary()
+    assert len(instrumentation_summary(top_n=1).splitlines()) == 2
+
+    write_instrumentation_report(str(tmp_path / "report.json"))
+    with open(tmp_path / "report.json") as f:
+        assert json.load(f) == report
+    reset_instrumentation()
@@ -0,0 +1,71 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import markdown
+
+import pykyll.markdown
+from pykyll.markdown import render_markdown, MarkdownCache, get_markdown_converter, read_markdown
+
+
+def test_pooled_converters_match_fresh_ones():
+    texts = [
+        "A footnote[^1] and an HTML abbreviation.\n\n[^1]: The note\n\n*[HTML]: Hyper Text Markup Language",
+        "A [reference link][ref]\n\n[ref]: https://example.com",
+        "No HTML here, no [ref] and no footnote[^1]",
+        "```\ncode\n```\n\n| a | b |\n|---|---|\n| 1 | 2 |",
+        "<div markdown=\"1\">*inside*</div>"]
+    for text in texts * 2:
+        for extensions in [('extra',), ('extra', 'fenced_code')]:
+            expected = markdown.markdown(text, extensions=list(extensions), output_format='html')
+            assert get_markdown_converter(extensions).convert(text) == expected
+    assert get_markdown_converter(('extra',)) is get_markdown_converter(('extra',))
+
+    # Each thread has its own converters
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(get_markdown_converter, ('extra',)).result() is not get_markdown_converter(('extra',))
+
+
+def test_read_markdown_matches_markdown(tmp_path):
+    md = "A line  \nbreak\n\n---\n\n![image](x.png)\n\n*emphasis*"
+    path = tmp_path / "page.md"
+    path.write_text(md)
+    assert read_markdown(str(path)) == markdown.markdown(md)
+    assert "<br />" in read_markdown(str(path))
+    assert render_markdown(md) == markdown.markdown(md, extensions=['extra', 'fenced_code'], output_format='html')
+
+
+def test_markdown_cache(tmp_path, monkeypatch):
+    cache = MarkdownCache(str(tmp_path))
+    text = "Some *markdown* text"
+    html, html_hash = cache.render(text)
+    assert html == render_markdown(text)
+    assert html_hash == hashlib.sha256(html.encode()).hexdigest()
+
+    # Different options are cached separately
+    assert cache.render(text, clean=True, linkify=True)[0] == render_markdown(text, clean=True, linkify=True)
+    assert MarkdownCache.make_key(text) == MarkdownCache.make_key(text, embedded_code=True)
+    assert MarkdownCache.make_key(text) != MarkdownCache.make_key(text, embedded_code=False)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("markdown should not be rendered")
+    monkeypatch.setattr(pykyll.markdown, "render_markdown", fail)
+    assert MarkdownCache(str(tmp_path)).render(text) == (html, html_hash)
+
+
+def test_markdown_cache_eviction(tmp_path):
+    cache = MarkdownCache(str(tmp_path), max_entries=10)
+    for i in range(10):
+        cache.render(f"text {i}")
+    assert len(os.listdir(tmp_path)) == 10
+
+    # Using the oldest entry makes it the most recent, so it survives the eviction
+    first_key = MarkdownCache.make_key("text 0")
+    os.utime(cache.blobs.path_for(first_key), (0, 0))
+    for i in range(1, 10):
+        os.utime(cache.blobs.path_for(MarkdownCache.make_key(f"text {i}")), (i, i))
+    cache.render("text 0")
+    cache.render("text 10")
+    assert len(os.listdir(tmp_path)) == 9
+    assert os.path.exists(cache.blobs.path_for(first_key))
+    assert not os.path.exists(cache.blobs.path_for(MarkdownCache.make_key("text 1")))
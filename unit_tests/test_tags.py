@@ -0,0 +1,63 @@
+import os
+from datetime import datetime
+
+from pykyll.blog_builder import PostMetadata
+from pykyll.build_graph import BuildGraph
+from pykyll.site import Site
+from pykyll.tags import TagIndex, build_tag_pages, tag_page_filename
+from pykyll.templater import Templater
+
+
+def make_metadata(day: int, tags: list[str]) -> PostMetadata:
+    return PostMetadata(
+        filename=f"_posts/2023-01-{day:02}T10-00.md", title=f"Post {day}", slug=f"post-{day}", page_image=None,
+        timestamp=datetime(2023, 1, day, 10), guid=str(day), hash=f"hash{day}", tags=tags, hide_title=False,
+        twitter=None, version=1, redirect_url=None, is_draft=False, content_line_no=1, base_url="posts",
+        is_dirty=False)
+
+
+def test_tag_index():
+    all_metadata = [make_metadata(1, ["c++", "python"]), make_metadata(3, ["python"]), make_metadata(2, None)]
+    tag_index = TagIndex(all_metadata)
+    assert tag_index.tags == ["c++", "python"]
+    assert tag_index.counts == {"c++": 1, "python": 2}
+    assert [metadata.timestamp.day for metadata in tag_index.posts_for("python")] == [3, 1]
+    assert tag_index.posts_for("rust") == []
+    assert tag_page_filename("c++", 1) == "tags/cpp/index.html"
+    assert tag_page_filename("c++", 2) == "tags/cpp/page-2.html"
+
+
+def test_tags_with_the_same_slug_are_grouped():
+    all_metadata = [make_metadata(1, ["C++", "c++"]), make_metadata(2, ["c++"]), make_metadata(3, ["C++"]),
+                    make_metadata(4, ["csharp"]), make_metadata(5, ["c#"])]
+    tag_index = TagIndex(all_metadata)
+    assert tag_index.tags == ["c#", "C++"]
+    assert tag_index.counts == {"c#": 2, "C++": 3}
+    assert [metadata.timestamp.day for metadata in tag_index.posts_for("c++")] == [3, 2, 1]
+    assert [metadata.timestamp.day for metadata in tag_index.posts_for("csharp")] == [5, 4]
+
+
+def test_build_tag_pages(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("templates")
+    with open("templates/tag.html", "w") as f:
+        f.write("{{ tag }} {{ page }}/{{ page_count }}:{% for post in posts %} {{ post.title }}{% endfor %}")
+    site = Site(name="Site", subtitle="", default_page_summary="", public_url="https://example.com",
+                image="", keywords="", author="", output_dir="web")
+    all_metadata = [make_metadata(day, ["odd" if day % 2 else "even", "all"]) for day in range(1, 6)]
+
+    def build() -> int:
+        graph = BuildGraph("graph.json")
+        rendered = build_tag_pages(Templater(site, "templates", build_graph=graph), TagIndex(all_metadata), "tag.html",
+                                   posts_per_page=2)
+        graph.save()
+        return rendered
+
+    assert build() == 3 + 1 + 2
+    with open("web/tags/all/page-3.html") as f:
+        assert f.read() == "all 3/3: Post 1"
+    assert build() == 0
+
+    # Only the pages containing the post are re-rendered
+    all_metadata[0].hash = "changed"
+    assert build() == 2
@@ -0,0 +1,135 @@
+import os
+
+import pytest
+from jinja2 import TemplateNotFound
+
+import pykyll.fileutils
+
+from pykyll.blog_builder import read_metadata
+from pykyll.build_graph import BuildGraph
+from pykyll.site import Site
+from pykyll.templater import Templater, get_file_based_environment, set_template_bytecode_cache, \
+    get_string_based_environment, get_string_template, plain_template_text, file_based_environments, \
+    string_based_environments, max_environments, render_string_template
+
+post_text = """<script>
+{{"guid": "1", "slug": "p", "hash": "h", "version": 1}}
+</script>
+# {title}
+"""
+
+
+def make_site(output_dir: str) -> Site:
+    return Site(name="Site", subtitle="", default_page_summary="", public_url="https://example.com",
+                image="", keywords="", author="", output_dir=output_dir)
+
+
+def write_file(path, text: str):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_incremental_render_to_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("templates")
+    write_file("templates/base.html", "{{ site.name }}: {% block content %}{% endblock %}")
+    write_file("templates/page.html", '{% extends "base.html" %}{% block content %}{% include "part.html" %}'
+                                      '{% for m in posts %}{{ m.title }}{% endfor %}{% endblock %}')
+    write_file("templates/part.html", "[{{ title }}]")
+    os.mkdir("posts")
+    write_file("posts/2023-01-01T10-00.md", post_text.format(title="Post"))
+
+    def build(**kwargs) -> bool:
+        graph = BuildGraph("graph.json")
+        templater = Templater(make_site("web"), "templates", build_graph=graph)
+        posts = [read_metadata("posts/2023-01-01T10-00.md", "posts")]
+        rendered = templater.render_to_file("page.html", "index.html", posts=posts, **kwargs)
+        graph.save()
+        return rendered
+
+    def output():
+        with open("web/index.html") as f:
+            return f.read()
+
+    assert build(title="one")
+    assert output() == "Site: [one]Post"
+    assert not build(title="one")
+    # Changes to data, volatile data, templates (including extended and included ones) and posts
+    assert build(title="two")
+    assert not build(title="two", date="today", volatile_args=("date",))
+    write_file("templates/part.html", "({{ title }})")
+    assert build(title="two")
+    assert output() == "Site: (two)Post"
+    write_file("templates/base.html", "{{ site.name }} - {% block content %}{% endblock %}")
+    assert build(title="two")
+    write_file("posts/2023-01-01T10-00.md", post_text.format(title="Post2"))
+    assert build(title="two")
+    assert output() == "Site - (two)Post2"
+    assert not build(title="two")
+    graph = BuildGraph("graph.json")
+    assert graph.outputs_depending_on(["./templates/part.html"]) == [os.path.join("web", "index.html")]
+    assert graph.outputs_depending_on(["templates/other.html"]) == []
+    os.remove("web/index.html")
+    assert build(title="two")
+
+    # Inputs are only read again (to hash them) if their size or modification time has changed
+    def no_hashing(path):
+        raise AssertionError(f"{path} was hashed")
+    monkeypatch.setattr(pykyll.fileutils, "hash_file", no_hashing)
+    assert not build(title="two")
+
+
+def test_deleted_include_is_not_found(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("templates")
+    write_file("templates/page.html", '{% include "part.html" %}')
+    write_file("templates/part.html", "part")
+    templater = Templater(make_site("web"), "templates", build_graph=BuildGraph("graph.json"))
+    assert templater.render_to_file("page.html", "index.html")
+    os.remove("templates/part.html")
+    with pytest.raises(TemplateNotFound):
+        templater.render_to_file("page.html", "index.html")
+
+
+def test_environment_reuse(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    filters = {"shout": lambda text: text.upper()}
+    assert get_file_based_environment() is get_file_based_environment()
+    assert get_file_based_environment(filters) is get_file_based_environment(dict(filters))
+    assert get_file_based_environment(filters) is not get_file_based_environment()
+
+    write_file("page.html", "{{ text | shout }}")
+    set_template_bytecode_cache(str(tmp_path / "bytecode"))
+    try:
+        assert Templater.render_from_template(".", "page.html", filters=filters, text="hi") == "HI"
+        template = get_file_based_environment(filters).get_template("page.html")
+        assert Templater.render_from_template(".", "page.html", filters=filters, text="there") == "THERE"
+        assert get_file_based_environment(filters).get_template("page.html") is template
+        assert len(os.listdir(tmp_path / "bytecode")) == 1
+    finally:
+        set_template_bytecode_cache(None)
+
+
+def test_environments_for_fresh_filters_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for i in range(max_environments * 2):
+        filters = {"number": lambda text, i=i: f"{text} {i}"}
+        assert get_file_based_environment(filters).filters["number"] is filters["number"]
+        assert render_string_template("{{ 'text' | number }}", filters) == f"text {i}"
+    assert len(file_based_environments) == max_environments
+    assert len(string_based_environments) == max_environments
+
+
+def test_plain_template_text():
+    for text in ["", "\n", "plain", "plain\n", "two\n\n", "a\r\nb\rc\nd\r\n", "  indented\n  lines  ", "{ braces }"]:
+        assert plain_template_text(text) == get_string_based_environment().from_string(text).render()
+        assert Templater.render_from_string_raw(text) == plain_template_text(text)
+
+
+def test_string_template_cache():
+    filters = {"shout": lambda text: text.upper()}
+    template = get_string_template("{{ text | shout }}", filters)
+    assert get_string_template("{{ text | shout }}", filters) is template
+    other_filters = {"shout": lambda text: text + "!"}
+    assert get_string_template("{{ text | shout }}", other_filters) is not template
+    assert Templater.render_from_string_raw("{{ text | shout }}!\n", filters, text="hi") == "HI!"
@@ -1,6 +1,14 @@
-from pykyll.fileutils import path_diff
+import os
+import random
+
+import pytest
+from markupsafe import Markup
+
+from pykyll import fileutils
+from pykyll.fileutils import path_diff, sync_files, SyncStats, HARDLINK, COPY_FILE_RANGE, COPY, \
+    SyncManifest
 from pykyll.utils import ordinal, exhaustive_replace, truncate_text_by_sentence, common_prefix, dict_merge, \
-    common_suffix
+    common_suffix, Replacer, truncate_prefix_by_sentence
 
 
 def test_ordinals():
@@ -22,6 +30,58 @@ def test_exhaustive_replace():
     assert exhaustive_replace("abcd", {"b": "a", "d": "c", "c": "b"}) == "aaaa"
 
 
+def test_replacer_compiles_confluent_tables():
+    assert Replacer({'"': "'", "\n": " ", "\t": " ", "  ": " ", "!": ".", "?": "."}).is_compiled
+    assert Replacer({"--": "-"}).replace("a" + "-" * 1000 + "b") == "a-b"
+    assert Replacer({"\\\\": "\\"}).replace("a\\\\\\\\\\b") == "a\\b"
+
+    # The result of these depends on the order the replacements are made in
+    assert not Replacer({"b": "a", "d": "c", "c": "b"}).is_compiled
+    assert not Replacer({"ab": "b", "b": "a"}).is_compiled
+    assert not Replacer({"a": "aa"}).is_compiled
+
+
+def reference_replace(text: str, replacements: dict[str, str]) -> str | None:
+    """
+    Applies the replacements, in table order, until none of them change the text - as exhaustive_replace() always
+    used to. (Also used by test_html.py)
+    """
+    for _ in range(100):
+        keep_looping = False
+        for f, to in replacements.items():
+            replaced = text.replace(f, to)
+            if replaced != text:
+                text = replaced
+                keep_looping = True
+        if not keep_looping:
+            return text
+    return None  # Doesn't terminate
+
+
+def test_exhaustive_replace_keeps_str_subclasses():
+    assert Replacer({"  ": " ", "\t": " "}).is_compiled
+    text = exhaustive_replace(Markup("a    b\t<c>"), {"  ": " ", "\t": " "})
+    assert text == Markup("a b <c>")
+    assert type(text) is Markup
+
+
+def test_replacer_matches_reference():
+    rng = random.Random(0)
+    alphabet = "ab \\"
+    for _ in range(1000):
+        replacements = {}
+        for _ in range(rng.randint(1, 4)):
+            f = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+            replacements[f] = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, len(f))))
+        replacements = {f: to for f, to in replacements.items() if f != to}
+        replacer = Replacer(replacements)
+        for _ in range(50):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+            expected = reference_replace(text, replacements)
+            if expected is not None:
+                assert replacer.replace(text) == expected, (replacements, text)
+
+
 def test_truncate_text_by_sentence():
     sentences = ["This is a really long sentence", "This is an even longer sentence"]
     text = ". ".join(sentences)
@@ -33,6 +93,26 @@ def test_truncate_text_by_sentence():
     assert truncate_text_by_sentence(text, 10, allow_sentence_to_be_cut=True) == "This is a"
 
 
+def test_truncate_prefix_by_sentence():
+    text = "First sentence. Second sentence\nThird. Fourth sentence."
+    assert truncate_prefix_by_sentence(text, 100) == (text, False)
+    assert truncate_prefix_by_sentence(text, 20) == ("First sentence", True)
+    assert truncate_prefix_by_sentence("First sente", 5) == ("First sente", False)
+    assert truncate_prefix_by_sentence("First sente", 5, allow_sentence_to_be_cut=True) == ("First", True)
+
+    # Once final, the truncated text is the same whatever follows
+    rng = random.Random(18)
+    pieces = ["a", "bb", " ", ".", "\n", "word", "..", "\t"]
+    for _ in range(2000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30))).strip()
+        max_length = rng.randint(0, 20)
+        expected = truncate_text_by_sentence(text, max_length)
+        for end in range(len(text)):
+            truncated, is_final = truncate_prefix_by_sentence(text[:end], max_length)
+            if is_final:
+                assert truncated == expected, (text, end)
+
+
 def test_common_prefix():
     assert common_prefix("abcdef", "abcxyz") == "abc"
     assert common_prefix("abc", "abc") == "abc"
@@ -126,3 +206,131 @@ def test_dict_merge():
     assert dict_merge(d1, d2) == d1_2
     assert dict_merge(d1, d3) == d1_3
     assert dict_merge(d2, d3) == d2_3
+
+
+def make_files(root, files: dict[str, str]):
+    for path, content in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def test_sync_files(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    make_files(source, {"a.txt": "a", "sub/b.txt": "bb", "sub/deeper/c.css": "ccc"})
+
+    stats = SyncStats()
+    processed = []
+
+    def processor(source_path, target_path):
+        processed.append(os.path.relpath(target_path, target))
+        return source_path.endswith(".css")
+
+    assert sync_files(source, target, processor=processor, stats=stats) == 3
+    assert sorted(processed) == ["a.txt", "sub/b.txt", "sub/deeper/c.css"]
+    assert stats == SyncStats(files_copied=2, bytes_copied=3, files_processed=1)
+    with open(os.path.join(target, "sub", "b.txt")) as f:
+        assert f.read() == "bb"
+
+    stats = SyncStats()
+    assert sync_files(source, target, stats=stats) == 1  # The processor didn't write the css file
+    assert sync_files(source, target, stats=stats) == 0
+    assert stats.files_up_to_date == 2 + 3
+
+    os.utime(os.path.join(source, "a.txt"), (2**31, 2**31))
+    assert sync_files(source, target) == 1
+    assert sync_files(source, target, always_copy=True) == 3
+
+
+def test_sync_files_modes(tmp_path):
+    source = str(tmp_path / "source")
+    make_files(source, {"a.txt": "a", "sub/b.txt": "bb"})
+
+    stats = SyncStats()
+    assert sync_files(source, str(tmp_path / "linked"), mode=HARDLINK, stats=stats) == 2
+    assert os.path.samefile(os.path.join(source, "sub", "b.txt"), str(tmp_path / "linked" / "sub" / "b.txt"))
+    assert (stats.files_linked, stats.bytes_linked, stats.files_copied) == (2, 3, 0)
+    assert sync_files(source, str(tmp_path / "linked"), mode=HARDLINK, always_copy=True) == 2
+
+    assert sync_files(source, str(tmp_path / "copied"), mode=COPY_FILE_RANGE) == 2
+    with open(tmp_path / "copied" / "sub" / "b.txt") as f:
+        assert f.read() == "bb"
+    assert os.stat(tmp_path / "copied" / "a.txt").st_mtime == os.stat(os.path.join(source, "a.txt")).st_mtime
+    assert sync_files(source, str(tmp_path / "copied"), mode=COPY_FILE_RANGE) == 0
+
+
+def test_sync_files_over_hard_links(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    make_files(source, {"a.txt": "a", "sub/b.css": "bb"})
+    assert sync_files(source, target, mode=HARDLINK) == 2
+
+    # Syncing over the links, in any mode, must replace them rather than writing through them into the sources
+    for mode in [COPY_FILE_RANGE, COPY]:
+        assert sync_files(source, target, mode=mode, always_copy=True) == 2
+        assert not os.path.samefile(os.path.join(source, "a.txt"), os.path.join(target, "a.txt"))
+        assert sync_files(source, target, mode=HARDLINK, always_copy=True) == 2
+    with open(os.path.join(source, "a.txt")) as f:
+        assert f.read() == "a"
+
+    def processor(source_path, target_path):
+        if not target_path.endswith(".css"):
+            return False
+        with open(target_path, "w") as f:
+            f.write("processed")
+        return True
+    assert sync_files(source, target, processor=processor, always_copy=True) == 2
+    with open(os.path.join(source, "sub", "b.css")) as f:
+        assert f.read() == "bb"
+    with open(os.path.join(target, "sub", "b.css")) as f:
+        assert f.read() == "processed"
+
+
+def test_sync_files_leaves_no_temporary_files(tmp_path, monkeypatch):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    make_files(source, {"x.css": "x", "x.css.copy": "copy", "x.css.link": "link"})
+    for mode in [HARDLINK, COPY_FILE_RANGE, COPY]:
+        assert sync_files(source, target, mode=mode, always_copy=True) == 3
+        assert sorted(os.listdir(target)) == ["x.css", "x.css.copy", "x.css.link"]
+        with open(os.path.join(target, "x.css.copy")) as f:
+            assert f.read() == "copy"
+
+    # ...even if copying fails
+    def fail(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(fileutils.shutil, "copy2", fail)
+    with pytest.raises(OSError):
+        sync_files(source, target, always_copy=True)
+    assert sorted(os.listdir(target)) == ["x.css", "x.css.copy", "x.css.link"]
+
+
+def test_sync_files_with_manifest(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    manifest_path = str(tmp_path / "manifest.json")
+    make_files(source, {"a.txt": "a", "sub/b.txt": "bb"})
+
+    manifest = SyncManifest(manifest_path)
+    assert sync_files(source, target, manifest=manifest) == 2
+    manifest.save()
+
+    # As after a fresh clone: the same contents, but newer modification times
+    for path in ["a.txt", "sub/b.txt"]:
+        os.utime(os.path.join(source, path), (2**31, 2**31))
+    manifest = SyncManifest(manifest_path)
+    stats = SyncStats()
+    assert sync_files(source, target, manifest=manifest, stats=stats) == 0
+    assert stats.files_up_to_date == 2
+
+    make_files(source, {"sub/b.txt": "changed"})
+    assert sync_files(source, target, manifest=manifest) == 1
+    make_files(target, {"a.txt": "edited in the output"})
+    assert sync_files(source, target, manifest=manifest) == 1
+    with open(os.path.join(target, "a.txt")) as f:
+        assert f.read() == "a"
+
+    os.remove(os.path.join(source, "sub", "b.txt"))
+    stats = SyncStats()
+    assert sync_files(source, target, manifest=manifest, stats=stats) == 0
+    assert stats.files_removed == 1
+    assert not os.path.exists(os.path.join(target, "sub", "b.txt"))
+    assert os.path.exists(os.path.join(target, "a.txt"))
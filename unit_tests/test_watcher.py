@@ -0,0 +1,113 @@
+import ctypes
+import errno
+import os
+import shutil
+import sys
+import threading
+import time
+
+import pytest
+
+from pykyll.contentengine import ContentEngine
+from pykyll.watcher import watch, PollingWatcher, make_watcher, InotifyWatcher, inotify_event_header, \
+    IN_Q_OVERFLOW
+
+
+def write_file(path, text: str):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def check_watcher(watcher, tmp_path):
+    try:
+        assert watcher.wait_for_changes(0.05) == set()
+        write_file(tmp_path / "_posts" / "post.md", "# A post")
+        os.mkdir(tmp_path / "_posts" / "sub")
+        write_file(tmp_path / "_posts" / "sub" / "other.md", "# Another post")
+        changed = set()
+        deadline = time.monotonic() + 5
+        while len(changed) < 2 and time.monotonic() < deadline:
+            changed |= watcher.wait_for_changes(1)
+        assert {os.path.join(str(tmp_path), "_posts", "post.md"),
+                os.path.join(str(tmp_path), "_posts", "sub", "other.md")} <= changed
+    finally:
+        watcher.close()
+
+
+def test_watchers(tmp_path):
+    os.mkdir(tmp_path / "_posts")
+    check_watcher(PollingWatcher([str(tmp_path / "_posts")], poll_interval=0.01), tmp_path)
+
+    os.mkdir(tmp_path / "other")
+    os.rename(tmp_path / "_posts", tmp_path / "other" / "_posts")
+    os.mkdir(tmp_path / "_posts")
+    check_watcher(make_watcher([str(tmp_path / "_posts")]), tmp_path)
+
+
+def wait_for(watcher, paths: set[str]) -> set[str]:
+    changed = set()
+    deadline = time.monotonic() + 5
+    while not paths <= changed and time.monotonic() < deadline:
+        changed |= watcher.wait_for_changes(1)
+    return changed
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is only on Linux")
+def test_inotify_watcher_directory_changes(tmp_path, monkeypatch):
+    posts = tmp_path / "_posts"
+    for subdir in ["moved", "deleted"]:
+        os.makedirs(posts / subdir / "deeper")
+        write_file(posts / subdir / "deeper" / "post.md", "# A post")
+    moved_post = str(posts / "moved" / "deeper" / "post.md")
+    deleted_post = str(posts / "deleted" / "deeper" / "post.md")
+    watcher = InotifyWatcher([str(posts)], poll_interval=0.01)
+    try:
+        # Moving or deleting a directory changes the files that were in it
+        os.rename(posts / "moved", tmp_path / "moved")
+        assert moved_post in wait_for(watcher, {moved_post})
+        shutil.rmtree(posts / "deleted")
+        assert deleted_post in wait_for(watcher, {deleted_post})
+        write_file(tmp_path / "moved" / "deeper" / "post.md", "# Not watched now")
+        assert watcher.wait_for_changes(0.05) == set()
+
+        # If events are lost, everything has to be taken to have changed
+        write_file(posts / "post.md", "# Another post")
+        assert watcher.wait_for_changes(1) == {str(posts / "post.md")}
+        assert watcher.handle_events(inotify_event_header.pack(-1, IN_Q_OVERFLOW, 0, 0)) == {str(posts / "post.md")}
+
+        # If a new directory can't be watched, it falls back to polling
+        def no_more_watches(*args):
+            ctypes.set_errno(errno.ENOSPC)
+            return -1
+        monkeypatch.setattr(watcher.libc, "inotify_add_watch", no_more_watches)
+        os.makedirs(posts / "new")
+        write_file(posts / "new" / "post.md", "# New post")
+        new_post = str(posts / "new" / "post.md")
+        assert new_post in wait_for(watcher, {new_post})
+        assert watcher.poller is not None
+        write_file(posts / "new" / "post.md", "# Edited post, with a different size")
+        assert wait_for(watcher, {new_post}) == {new_post}
+    finally:
+        watcher.close()
+
+
+def test_watch(tmp_path):
+    for subdir in ["_posts", "_templates"]:
+        os.mkdir(tmp_path / subdir)
+    rebuilds = []
+    stop = threading.Event()
+
+    def rebuild(changed: set[str]):
+        rebuilds.append(changed)
+        stop.set()
+
+    ce = ContentEngine(sources_root=str(tmp_path))
+    thread = threading.Thread(target=watch, args=(ce, rebuild), kwargs={"poll_interval": 0.01, "stop": stop})
+    thread.start()
+    time.sleep(0.2)
+    write_file(tmp_path / "_templates" / "page.html", "one")
+    write_file(tmp_path / "_posts" / "post.md", "# A post")
+    thread.join(5)
+    stop.set()
+    assert rebuilds == [{os.path.join(str(tmp_path), "_templates", "page.html"),
+                         os.path.join(str(tmp_path), "_posts", "post.md")}]
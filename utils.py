@@ -1,7 +1,9 @@
 import calendar
 import copy
+import re
 from datetime import datetime
 from collections.abc import Mapping
+from functools import lru_cache
 
 
 def empty_or_null(string: str):
@@ -69,46 +71,172 @@ def format_datetime_for_rss(date):
     return date.strftime(format="%a, %d %b %Y %H:%M:%S %z") + "+0000"
 
 
-def exhaustive_replace(text: str, replacements: {str, str}) -> str:
+class Replacer:
     """
-    Keeps replacing strings until no replacements are made
+    A replacement table compiled for repeated use by exhaustive_replace().
+    If the table can be shown to always reach the same result, whatever order replacements are made in, then
+    replacements are made in whatever order is quickest: patterns that aren't present are skipped, and repetitions
+    (e.g. "  " -> " ") are collapsed by a regex in one go, rather than halving each pass - so the text is usually
+    done in one pass (plus a check that nothing is left).
+    Otherwise it falls back to making the replacements in table order, pass after pass, exactly as before
     """
-    keep_looping = True
-    while keep_looping:
-        keep_looping = False
-        for (f, to) in replacements.items():
-            replaced = text.replace(f, to)
-            if text != replaced:
-                text = replaced
-                keep_looping = True
-    return text
+    def __init__(self, replacements: dict[str, str]):
+        self.replacements = dict(replacements)
+        self.is_compiled = False
+        self.is_compiled = self.terminates() and self.compile() and self.is_confluent()
+
+    def terminates(self) -> bool:
+        """
+        Checks that every replacement either shortens the text or (keeping the length the same) reduces the count of
+        characters that appear in any length-preserving pattern - so replacing can't go on forever, in any order
+        """
+        if any(f == "" for f in self.replacements):
+            return False
+        same_length_chars = {c for f, to in self.replacements.items() if len(f) == len(to) for c in f}
+
+        def count(text: str) -> int:
+            return sum(1 for c in text if c in same_length_chars)
+
+        return all(len(to) < len(f) or (len(to) == len(f) and count(to) < count(f))
+                   for f, to in self.replacements.items())
+
+    def compile(self) -> bool:
+        """
+        Works out, for each replacement, which patterns it could create (by sharing a character with them or, if it
+        replaces with nothing, by joining up the text either side), so only those need checking again afterwards
+        """
+        self.compiled_replacements = []
+        patterns = list(self.replacements)
+        for f, to in self.replacements.items():
+            collapser = None
+            if to and f == to * 2:
+                # Collapse any number of repetitions in one go
+                collapser = (re.compile(f"(?:{re.escape(to)}){{2,}}"), to.replace("\\", "\\\\"))
+            creates = [i for i, pattern in enumerate(patterns) if not to or set(to) & set(pattern)]
+            self.compiled_replacements.append((f, to, collapser, creates))
+        return True
 
+    def is_confluent(self) -> bool:
+        """
+        Checks every way that two patterns can overlap (or one contain another) gives the same end result,
+        whichever is replaced first. As replacing terminates, this means the result is the same for any order
+        """
+        rules = list(self.replacements.items())
+        for l1, r1 in rules:
+            for l2, r2 in rules:
+                candidates = []
+                for k in range(1, min(len(l1), len(l2))):
+                    if l1[-k:] == l2[:k]:
+                        candidates.append((l1[:-k] + l2, r1 + l2[k:], l1[:-k] + r2))
+                if l1 != l2:
+                    start = l1.find(l2)
+                    while start != -1:
+                        candidates.append((l1, r1, l1[:start] + r2 + l1[start+len(l2):]))
+                        start = l1.find(l2, start + 1)
+                for _, first, second in candidates:
+                    if self.replace_in_any_order(first) != self.replace_in_any_order(second):
+                        return False
+        return True
 
-def truncate_text_by_sentence(text: str, max_length: int, allow_sentence_to_be_cut=False) -> str:
-    paragraphs = [paragraph.strip() for paragraph in text.split("\n")]
-    truncated = ""
+    def replace_in_any_order(self, text: str) -> str:
+        to_check = range(len(self.compiled_replacements))
+        while to_check:
+            created = set()
+            for i in to_check:
+                f, to, collapser, creates = self.compiled_replacements[i]
+                if f in text:
+                    replaced = text.replace(f, to)
+                    # (Not for str subclasses, such as Markup, which the regex would turn into plain strs - their
+                    # repetitions are just halved on each pass instead)
+                    if collapser and f in replaced and type(replaced) is str:
+                        regex, template = collapser
+                        replaced = regex.sub(template, replaced)
+                    text = replaced
+                    created.update(creates)
+            to_check = sorted(created)
+        return text
+
+    def replace_in_table_order(self, text: str) -> str:
+        keep_looping = True
+        while keep_looping:
+            keep_looping = False
+            for (f, to) in self.replacements.items():
+                replaced = text.replace(f, to)
+                if text != replaced:
+                    text = replaced
+                    keep_looping = True
+        return text
+
+    def replace(self, text: str) -> str:
+        """
+        Keeps replacing strings until no replacements are made
+        """
+        if self.is_compiled:
+            return self.replace_in_any_order(text)
+        return self.replace_in_table_order(text)
+
+
+@lru_cache(maxsize=64)
+def get_replacer(replacements: tuple[tuple[str, str], ...]) -> Replacer:
+    return Replacer(dict(replacements))
+
+
+def exhaustive_replace(text: str, replacements: {str, str}) -> str:
+    """
+    Keeps replacing strings until no replacements are made
+    """
+    return get_replacer(tuple(replacements.items())).replace(text)
 
-    for p in [p for p in paragraphs if p != ""]:
-        sentences = [sentence.strip() for sentence in p.split(".")]
 
-        for i, sentence in enumerate(sentences):
-            if i == 0:
-                longer_text = truncated + sentence
+def truncate_prefix_by_sentence(text: str, max_length: int, allow_sentence_to_be_cut=False) -> tuple[str, bool]:
+    """
+    Truncates text in the same way as truncate_text_by_sentence(), where text may only be the start of the full text.
+    Also returns whether the truncated text is final - i.e. whether it would be the same whatever text followed
+    """
+    truncated = []
+    length = 0
+    paragraph_start = 0
+    while True:
+        paragraph_end = text.find("\n", paragraph_start)
+        is_last_paragraph = paragraph_end == -1
+        paragraph = text[paragraph_start:len(text) if is_last_paragraph else paragraph_end].strip()
+
+        sentence_start = 0
+        is_first_sentence = True
+        while paragraph:
+            sentence_end = paragraph.find(".", sentence_start)
+            is_last_sentence = sentence_end == -1
+            sentence = paragraph[sentence_start:len(paragraph) if is_last_sentence else sentence_end].strip()
+            if is_first_sentence:
+                addition = [sentence]
             elif sentence == "":
-                longer_text = truncated + "."
+                addition = ["."]
             else:
-                longer_text = truncated + ". " + sentence
-            if len(longer_text) <= max_length:
-                truncated = longer_text
-            else:
-                if len(truncated) == 0:
-                    if allow_sentence_to_be_cut:
-                        truncated = longer_text[:max_length].strip()
-                    else:
-                        truncated = longer_text
-                return truncated.strip()
-        truncated = truncated.strip() + "\n"
-    return truncated.strip()
+                addition = [". ", sentence]
+            addition_length = sum(len(part) for part in addition)
+            if length + addition_length > max_length:
+                # Only the last sentence might not be complete, and that only matters if it's all we have
+                is_final = length > 0 or allow_sentence_to_be_cut or not (is_last_sentence and is_last_paragraph)
+                if length == 0:
+                    longer_text = "".join(truncated + addition)
+                    return longer_text[:max_length].strip() if allow_sentence_to_be_cut else longer_text, is_final
+                return "".join(truncated).strip(), is_final
+            truncated += addition
+            length += addition_length
+            if is_last_sentence:
+                truncated = ["".join(truncated).strip(), "\n"]
+                length = len(truncated[0]) + 1
+                break
+            sentence_start = sentence_end + 1
+            is_first_sentence = False
+
+        if is_last_paragraph:
+            return "".join(truncated).strip(), False
+        paragraph_start = paragraph_end + 1
+
+
+def truncate_text_by_sentence(text: str, max_length: int, allow_sentence_to_be_cut=False) -> str:
+    return truncate_prefix_by_sentence(text, max_length, allow_sentence_to_be_cut)[0]
 
 
 def reduce_text_to(text: str, max_len: int) -> str:
@@ -0,0 +1,271 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from pykyll.contentengine import ContentEngine
+from pykyll.fileutils import file_signature
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+inotify_event_header = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """
+    Detects changes to files in the watched directories by periodically comparing their sizes and modification times
+    """
+    def __init__(self, directories: list[str], poll_interval: float = 0.5):
+        self.directories = directories
+        self.poll_interval = poll_interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self) -> dict[str, list[int]]:
+        snapshot = {}
+        for directory in self.directories:
+            for root, _, files in os.walk(directory):
+                for file in files:
+                    path = os.path.join(root, file)
+                    try:
+                        snapshot[path] = file_signature(path)
+                    except OSError:
+                        pass  # Deleted while we were looking
+        return snapshot
+
+    def wait_for_changes(self, timeout: float | None) -> set[str]:
+        """
+        Returns the paths that have changed (been modified, created or deleted), waiting up to timeout seconds
+        (forever, if None) for there to be any
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self.take_snapshot()
+            changed = {path for path in snapshot.keys() | self.snapshot.keys()
+                       if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            interval = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.monotonic())
+            time.sleep(max(interval, 0))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Detects changes to files in the watched directories (and any directories created within them) using Linux inotify.
+    If events are lost (the event queue overflows) every file is reported as changed, and if a new directory can't be
+    watched (e.g. the limit on watches has been reached) it falls back to polling
+    """
+    def __init__(self, directories: list[str], poll_interval: float = 0.5):
+        self.directories = directories
+        self.poll_interval = poll_interval
+        self.poller = None
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched_dirs = {}
+        self.known_files = set()
+        try:
+            for directory in directories:
+                self.known_files |= self.add_watches(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watches(self, directory: str) -> set[str]:
+        """
+        Watches the directory, and those within it, returning the files in them.
+        Each directory is watched before it's listed, so nothing created in it can be missed
+        """
+        files = set()
+        to_watch = [directory]
+        while to_watch:
+            path = to_watch.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # Deleted while we were looking
+                raise OSError(error, f"inotify_add_watch failed for {path}")
+            self.watched_dirs[wd] = path
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if not entry.is_dir():
+                            files.add(entry.path)
+                        elif not entry.is_symlink():
+                            to_watch.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        return files
+
+    def remove_watches(self, directory: str):
+        """
+        Stops watching the directory, and those within it (e.g. as it's been moved elsewhere)
+        """
+        prefix = os.path.join(directory, "")
+        for wd, path in list(self.watched_dirs.items()):
+            if path == directory or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watched_dirs[wd]
+
+    def files_under(self, directory: str) -> set[str]:
+        prefix = os.path.join(directory, "")
+        return {path for path in self.known_files if path.startswith(prefix)}
+
+    def rescan(self) -> set[str]:
+        """
+        Watches any directories that have been missed, and returns every file (that's there, or was) as changed
+        """
+        files = set()
+        for directory in self.directories:
+            files |= self.add_watches(directory)
+        changed = self.known_files | files
+        self.known_files = files
+        return changed
+
+    def handle_events(self, data: bytes) -> set[str]:
+        """
+        Returns the files changed by the inotify events in data
+        """
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = inotify_event_header.unpack_from(data, offset)
+            offset += inotify_event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed |= self.rescan()
+                continue
+            directory = self.watched_dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watched_dirs[wd]  # The directory has gone
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    files = self.add_watches(path)
+                    self.known_files |= files
+                    changed |= files
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    files = self.files_under(path)
+                    self.known_files -= files
+                    changed |= files
+                    self.remove_watches(path)
+            else:
+                changed.add(path)
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.known_files.discard(path)
+                else:
+                    self.known_files.add(path)
+        return changed
+
+    def wait_for_changes(self, timeout: float | None) -> set[str]:
+        if self.poller:
+            return self.poller.wait_for_changes(timeout)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            try:
+                changed |= self.handle_events(data)
+            except OSError as e:
+                print(f"Falling back to polling for changes: {e}")
+                self.poller = PollingWatcher(self.directories, self.poll_interval)
+                changed |= self.known_files | self.poller.snapshot.keys()
+                self.close()
+                break
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.poller:
+            self.poller.close()
+
+
+def make_watcher(directories: list[str], use_inotify=True, poll_interval: float = 0.5):
+    """
+    Returns an inotify based watcher where available, otherwise falls back to polling
+    """
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directories, poll_interval)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directories, poll_interval)
+
+
+def watched_directories(ce: ContentEngine) -> list[str]:
+    paths = [ce.posts_source_path, ce.content_source_path, ce.templates_root, ce.static_source_path,
+             ce.fonts_source_path]
+    return [os.path.normpath(path) for path in paths if os.path.isdir(path)]
+
+
+def watch(ce: ContentEngine,
+          rebuild: typing.Callable[[set[str]], None],
+          debounce: float = 0.1,
+          use_inotify=True,
+          poll_interval: float = 0.5,
+          stop: threading.Event | None = None):
+    """
+    Watches the source directories of the content engine, calling rebuild with the set of changed paths
+    each time they change. Bursts of changes (e.g. an editor saving several files) are gathered up until there have
+    been none for debounce seconds.
+    rebuild is expected to run the site's build with a BuildGraph (and caches), so only the outputs affected by the
+    changes are re-rendered.
+    Runs until interrupted (or stop is set)
+    """
+    watcher = make_watcher(watched_directories(ce), use_inotify, poll_interval)
+    print(f"Watching for changes using {type(watcher).__name__}")
+    try:
+        while stop is None or not stop.is_set():
+            changed = watcher.wait_for_changes(poll_interval if stop else None)
+            if not changed:
+                continue
+            while more_changes := watcher.wait_for_changes(debounce):
+                changed |= more_changes
+            changed = {os.path.normpath(path) for path in changed}
+
+            start_time = time.perf_counter()
+            try:
+                rebuild(changed)
+            except Exception:
+                traceback.print_exc()
+                print("Rebuild failed")
+                continue
+            print(f"Rebuilt in {time.perf_counter() - start_time:.3f}s after changes to {len(changed)} file(s)")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()